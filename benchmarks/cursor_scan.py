@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Compare Webex API pages fetched and memory allocated per poll by the
+original get_latest_commands against the streaming cursor scan.
+
+    python benchmarks/cursor_scan.py [--history 500] [--polls 50] [--new 1]
+"""
+
+import argparse
+import datetime
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'poller'))
+
+from webexteamssdk.models.immutable import Message  # noqa: E402
+
+import poller  # noqa: E402
+
+
+class fake_messages:
+    """messages.list emulation: newest first, lazily paginated like the SDK"""
+
+    def __init__(self):
+        self.history = list()
+        self.pages = 0
+        self.start = datetime.datetime(2022, 2, 10)
+
+    def add(self, count):
+        for _ in range(count):
+            idx = len(self.history)
+            created = self.start + datetime.timedelta(seconds=idx)
+            self.history.insert(0, Message({
+                'id': f'{idx:0104d}',
+                'roomId': 'room',
+                'text': 'Lab project list',
+                'personEmail': 'user@example.com',
+                'created': created.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            }))
+
+    def list(self, room_id, mentionedPeople=None, max=25, beforeMessage=None):
+        start = 0
+        if beforeMessage:
+            ids = [msg.id for msg in self.history]
+            start = ids.index(beforeMessage) + 1
+
+        def pages(start):
+            while start < len(self.history):
+                self.pages += 1
+                yield from self.history[start:start + max]
+                start += max
+
+        return pages(start)
+
+
+class fake_webex:
+    def __init__(self):
+        self.messages = fake_messages()
+
+
+def legacy_get_latest_commands(webex, room_id, latest_message_id, max_messages):
+    msg_iter = webex.messages.list(
+        room_id, mentionedPeople="me", max=int(max_messages)
+    )
+
+    if not latest_message_id:
+        for msg in msg_iter:
+            return msg.id, list()
+        return None, list()
+
+    commands = {msg.id: (msg.text, msg.personEmail) for msg in msg_iter}
+    msg_ids = list(commands.keys())
+
+    try:
+        latest_idx = msg_ids.index(latest_message_id)
+        new_msg_ids = msg_ids[:latest_idx]
+    except ValueError:
+        new_msg_ids = msg_ids
+
+    if len(new_msg_ids) == 0:
+        return latest_message_id, list()
+
+    latest_message_id = new_msg_ids[0]
+    new_msg_ids.reverse()
+
+    return latest_message_id, [
+        (id, str(commands[id][0]), str(commands[id][1])) for id in new_msg_ids
+    ]
+
+
+def run(name, poll, history, polls, new):
+    webex = fake_webex()
+    webex.messages.add(history)
+
+    cursor, _ = poll(webex, None, 1)
+    webex.messages.pages = 0
+
+    tracemalloc.start()
+    allocated = 0
+    commands = 0
+
+    for _ in range(polls):
+        webex.messages.add(new)
+
+        before = tracemalloc.take_snapshot()
+        cursor, found = poll(webex, cursor, 25)
+        after = tracemalloc.take_snapshot()
+
+        stats = after.compare_to(before, 'filename')
+        allocated += sum(max(0, stat.count_diff) for stat in stats)
+        commands += len(found)
+
+    tracemalloc.stop()
+
+    print(
+        f'{name:>10}: {webex.messages.pages / polls:8.2f} pages/poll  '
+        f'{allocated / polls:10.1f} objects/poll  '
+        f'{commands} commands'
+    )
+
+
+def main():
+    args = argparse.ArgumentParser()
+    args.add_argument('--history', type=int, default=500)
+    args.add_argument('--polls', type=int, default=50)
+    args.add_argument('--new', type=int, default=1)
+    opts = args.parse_args()
+
+    def legacy(webex, cursor, max_messages):
+        return legacy_get_latest_commands(webex, 'room', cursor, max_messages)
+
+    page_size = {'size': 2}
+
+    def streaming(webex, cursor, max_messages):
+        cursor, found = poller.get_latest_commands(
+            webex, 'room', cursor, max_messages,
+            page_size=page_size['size'] if cursor else 1,
+        )
+        page_size['size'] = min(25, max(2, 2 * len(found) + 1))
+        return cursor, found
+
+    run('legacy', legacy, opts.history, opts.polls, opts.new)
+    run('streaming', streaming, opts.history, opts.polls, opts.new)
+
+
+if __name__ == '__main__':
+    main()
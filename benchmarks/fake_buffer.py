@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the buffer service used by poller/buffer.py
+
+    python benchmarks/fake_buffer.py --port 7000 --backlog 5000
+
+Endpoints:
+    GET  /messages/                 all entries (drains them), 404 if empty
+    GET  /messages/?limit=N&cursor= one page: {"messages": [...], "next": ...}
+    POST /messages/ack              {"ids": [...]} acknowledge (delete)
+    POST /messages/                 enqueue one entry or a list of entries
+    GET  /messages/stream           NDJSON stream of entries as they arrive
+    POST /messages/lease            {"consumer", "limit", "visibility"} claim
+                                    {"lease": ..., "messages": [...]}
+    POST /messages/lease/ID/renew   {"visibility"} extend a lease
+    POST /messages/lease/ID/ack     {"ids": [...]} finish a lease
+    POST /messages/lease/ID/release hand a lease back
+"""
+
+import argparse
+import json
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class buffer_store:
+    def __init__(self):
+        # id -> entry, in arrival order, until acknowledged
+        self.entries = OrderedDict()
+        self.requests = 0
+        self.cond = threading.Condition()
+
+        # lease ID -> [expires at, entry IDs]; expired leases are re-delivered
+        self.leases = dict()
+        self.lease_count = 0
+        self.redelivered = 0
+
+    def add(self, entries):
+        with self.cond:
+            for entry in entries:
+                self.entries[entry['id']] = entry
+            self.cond.notify_all()
+
+    def page(self, limit, cursor=None):
+        with self.cond:
+            ids = list(self.entries)
+
+            start = 0
+            if cursor in self.entries:
+                start = ids.index(cursor) + 1
+
+            page_ids = ids[start:start + limit]
+            more = start + limit < len(ids)
+
+            return (
+                [self.entries[id] for id in page_ids],
+                page_ids[-1] if page_ids and more else None
+            )
+
+    def drain(self):
+        with self.cond:
+            entries = list(self.entries.values())
+            self.entries.clear()
+            return entries
+
+    def ack(self, ids):
+        with self.cond:
+            for id in ids:
+                self.entries.pop(id, None)
+
+    def _expire_leases(self):
+        now = time.monotonic()
+        for lease_id, (expires, ids) in list(self.leases.items()):
+            if expires <= now:
+                del self.leases[lease_id]
+                self.redelivered += len(ids)
+
+    def claim(self, consumer, limit, visibility):
+        with self.cond:
+            self._expire_leases()
+
+            leased = set()
+            for (expires, ids) in self.leases.values():
+                leased.update(ids)
+
+            ids = [id for id in self.entries if id not in leased][:limit]
+            if not ids:
+                return None, list()
+
+            self.lease_count += 1
+            lease_id = f'{consumer}-{self.lease_count}'
+            self.leases[lease_id] = [time.monotonic() + visibility, ids]
+
+            return lease_id, [self.entries[id] for id in ids]
+
+    def renew(self, lease_id, visibility):
+        with self.cond:
+            self._expire_leases()
+            if lease_id not in self.leases:
+                return False
+            self.leases[lease_id][0] = time.monotonic() + visibility
+            return True
+
+    def ack_lease(self, lease_id, ids):
+        with self.cond:
+            self._expire_leases()
+            if lease_id not in self.leases:
+                return False
+            for id in ids:
+                self.entries.pop(id, None)
+            del self.leases[lease_id]
+            return True
+
+    def release(self, lease_id):
+        with self.cond:
+            return self.leases.pop(lease_id, None) is not None
+
+    def wait_and_drain(self, timeout):
+        with self.cond:
+            if not self.entries:
+                self.cond.wait(timeout)
+            entries = list(self.entries.values())
+            self.entries.clear()
+            return entries
+
+
+class buffer_handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'null')
+
+    def do_GET(self):
+        store = self.server.store
+        store.requests += 1
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path == '/messages/stream':
+            return self.stream(store)
+
+        if url.path != '/messages/':
+            return self.send_json({'detail': 'Not Found'}, 404)
+
+        if 'limit' in query:
+            cursor = query.get('cursor', [None])[0]
+            entries, token = store.page(int(query['limit'][0]), cursor)
+            return self.send_json({'messages': entries, 'next': token})
+
+        entries = store.drain()
+        if not entries:
+            return self.send_json({'detail': 'No messages'}, 404)
+        return self.send_json(entries)
+
+    def do_POST(self):
+        store = self.server.store
+        store.requests += 1
+        payload = self.read_json()
+
+        if self.path == '/messages/ack':
+            store.ack(payload.get('ids', list()))
+            return self.send_json({'acked': len(payload.get('ids', list()))})
+
+        if self.path == '/messages/':
+            store.add(payload if isinstance(payload, list) else [payload])
+            return self.send_json({'queued': True}, 201)
+
+        if self.path == '/messages/lease':
+            lease_id, entries = store.claim(
+                payload.get('consumer', 'consumer'),
+                int(payload.get('limit', 100)),
+                float(payload.get('visibility', 30))
+            )
+            if not entries:
+                return self.send_json({'detail': 'No messages'}, 404)
+            return self.send_json({'lease': lease_id, 'messages': entries})
+
+        if self.path.startswith('/messages/lease/'):
+            lease_id, _, action = self.path[16:].rpartition('/')
+
+            if action == 'renew':
+                found = store.renew(
+                    lease_id, float((payload or dict()).get('visibility', 30))
+                )
+            elif action == 'ack':
+                found = store.ack_lease(lease_id, payload.get('ids', list()))
+            elif action == 'release':
+                found = store.release(lease_id)
+            else:
+                found = False
+
+            if not found:
+                return self.send_json({'detail': 'Lease not found'}, 404)
+            return self.send_json({'lease': lease_id})
+
+        return self.send_json({'detail': 'Not Found'}, 404)
+
+    def stream(self, store):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def chunk(data):
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.flush()
+
+        try:
+            while True:
+                entries = store.wait_and_drain(timeout=1.0)
+                if not entries:
+                    # Keep-alive so idle readers don't time out
+                    chunk(b'\n')
+                    continue
+                chunk(b''.join(
+                    json.dumps(entry).encode() + b'\n' for entry in entries
+                ))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def make_entries(count, room_id=None, start=0, text='Lab project list'):
+    entries = list()
+    for idx in range(start, start + count):
+        entry = {
+            'id': f'{idx:0104d}',
+            'text': text,
+            'email': f'user{idx % 50}@example.com',
+        }
+        if room_id:
+            entry['roomId'] = room_id
+        entries.append(entry)
+    return entries
+
+
+def make_server(host='127.0.0.1', port=0, backlog=0, room_id=None):
+    server = ThreadingHTTPServer((host, port), buffer_handler)
+    server.daemon_threads = True
+    server.store = buffer_store()
+    server.store.add(make_entries(backlog, room_id))
+    return server
+
+
+def main():
+    args = argparse.ArgumentParser()
+    args.add_argument('--host', default='127.0.0.1')
+    args.add_argument('--port', type=int, default=7000)
+    args.add_argument('--backlog', type=int, default=0)
+    args.add_argument('--room-id', default=None)
+    opts = args.parse_args()
+
+    server = make_server(opts.host, opts.port, opts.backlog, opts.room_id)
+    print(f'Fake buffer service on port {server.server_port}')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the conductor service used by poller/library.py
+
+    python benchmarks/fake_conductor.py --port 8000 --latency 20 --errors 0.01
+
+Serves /version/, /project/, /scenario/ and /reserve/project/ (list with
+skip/limit, details, create, cancel) from memory.  Every request is
+delayed by --latency ms (plus up to --jitter ms) and fails with a 500 at
+the --errors rate.  GETs carry an ETag and answer a matching If-None-Match
+with a 304; larger bodies are gzip compressed when the client accepts it.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class conductor_store:
+    def __init__(self, projects=20, scenarios_per_project=3,
+                 latency=0.0, jitter=0.0, error_rate=0.0):
+        self.latency = float(latency)
+        self.jitter = float(jitter)
+        self.error_rate = float(error_rate)
+
+        self.projects = {
+            f'project{idx}': {
+                'name': f'project{idx}',
+                'title': f'Project {idx}',
+                'description': f'Lab project number {idx}',
+            }
+            for idx in range(projects)
+        }
+        self.scenarios = {
+            f'scenario{idx}-{sub}': {
+                'name': f'scenario{idx}-{sub}',
+                'project': f'project{idx}',
+                'title': f'Scenario {sub} of project {idx}',
+                'description': 'Lab scenario',
+            }
+            for idx in range(projects)
+            for sub in range(scenarios_per_project)
+        }
+        self.reservations = dict()
+        self.leases = 0
+
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def delay(self):
+        pause = self.latency + random.uniform(0, self.jitter)
+        if pause > 0:
+            time.sleep(pause)
+
+    def fail(self):
+        return self.error_rate and random.random() < self.error_rate
+
+
+def page(items, query):
+    skip = int(query.get('skip', 0))
+    limit = int(query.get('limit', len(items) or 1))
+    return items[skip:skip + limit]
+
+
+class conductor_handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200, method='GET'):
+        body = json.dumps(payload).encode()
+        headers = {'Content-Type': 'application/json'}
+
+        if method == 'GET' and status == 200:
+            etag = '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+            headers['ETag'] = etag
+            if self.headers.get('If-None-Match') == etag:
+                self.server.store.calls['304'] += 1
+                status, body = 304, b''
+                del headers['Content-Type']
+
+        if len(body) > 1024 and \
+                'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'null')
+
+    def handle_request(self, method):
+        store = self.server.store
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        payload = self.read_json() if method != 'GET' else None
+
+        store.calls[method] += 1
+        store.delay()
+
+        if store.fail():
+            store.calls['500'] += 1
+            return self.send_json({'detail': 'Injected failure'}, 500)
+
+        with store.lock:
+            status, body = self.route(store, method, url.path, query, payload)
+        return self.send_json(body, status, method)
+
+    def route(self, store, method, path, query, payload):
+        not_found = (404, {'detail': 'Not Found'})
+
+        if path == '/version/':
+            return 200, {'version': '1.0.0'}
+
+        if path == '/project/':
+            if method == 'POST':
+                if payload['name'] in store.projects:
+                    return 409, {'detail': 'Project already exists'}
+                store.projects[payload['name']] = payload
+                return 200, payload
+            return 200, page([
+                {'name': p['name'], 'title': p['title']}
+                for p in store.projects.values()
+            ], query)
+
+        if path.startswith('/project/'):
+            project = store.projects.get(path[len('/project/'):])
+            return (200, project) if project else not_found
+
+        if path == '/scenario/':
+            if method == 'POST':
+                store.scenarios[payload['name']] = payload
+                return 200, payload
+            return 200, page([
+                {'name': s['name'], 'title': s['title'],
+                 'project': s['project']}
+                for s in store.scenarios.values()
+            ], query)
+
+        if path.startswith('/scenario/'):
+            scenario = store.scenarios.get(path[len('/scenario/'):])
+            return (200, scenario) if scenario else not_found
+
+        if path == '/reserve/project/':
+            if method == 'POST':
+                if payload['project'] not in store.projects:
+                    return 404, {'detail': 'Project not found'}
+                if payload['project'] in store.reservations:
+                    return 409, {'detail': 'Project already reserved'}
+                store.leases += 1
+                reservation = {
+                    'project': payload['project'],
+                    'email': payload['email'],
+                    'ttl': int(payload['duration']),
+                    'id': store.leases,
+                }
+                store.reservations[payload['project']] = reservation
+                return 200, reservation
+            return 200, page([
+                {'project': r['project'], 'email': r['email']}
+                for r in store.reservations.values()
+            ], query)
+
+        if path.startswith('/reserve/project/'):
+            project = path[len('/reserve/project/'):]
+            if method == 'DELETE':
+                if store.reservations.pop(project, None) is None:
+                    return 404, {'detail': 'No reservation'}
+                return 200, {'project': project}
+            reservation = store.reservations.get(project)
+            return (200, reservation) if reservation else not_found
+
+        return not_found
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+
+def make_server(host='127.0.0.1', port=0, latency=0.0, jitter=0.0,
+                error_rate=0.0, projects=20):
+    server = ThreadingHTTPServer((host, port), conductor_handler)
+    server.daemon_threads = True
+    server.store = conductor_store(
+        projects, latency=latency, jitter=jitter, error_rate=error_rate
+    )
+    return server
+
+
+def main():
+    args = argparse.ArgumentParser()
+    args.add_argument('--host', default='127.0.0.1')
+    args.add_argument('--port', type=int, default=8000)
+    args.add_argument('--latency', type=float, default=0, help='ms')
+    args.add_argument('--jitter', type=float, default=0, help='ms')
+    args.add_argument('--errors', type=float, default=0, help='0 to 1')
+    args.add_argument('--projects', type=int, default=20)
+    opts = args.parse_args()
+
+    server = make_server(
+        opts.host, opts.port, opts.latency / 1000.0, opts.jitter / 1000.0,
+        opts.errors, opts.projects
+    )
+    print(f'Fake conductor on port {server.server_port}')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
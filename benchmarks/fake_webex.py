@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the parts of the Webex REST API the services use
+
+    python benchmarks/fake_webex.py --port 7100 --rooms "Lab;Lab 2"
+
+Point the services at it with WEBEX_TEAMS_BASE_URL=http://HOST:PORT/v1/
+(any WEBEX_TEAMS_ACCESS_TOKEN works).
+
+Endpoints:
+    GET  /v1/rooms                  every room
+    GET  /v1/rooms/ID               one room
+    GET  /v1/messages?roomId=...    commands for the bot, newest first,
+                                    paged with max/beforeMessage and Link
+    GET  /v1/messages/ID            one message
+    POST /v1/messages               a reply (recorded, not listed)
+    GET  /v1/people/me              the bot
+
+messages.list and messages.create each have a calls/second budget; going
+over it gets a 429 with a Retry-After header, as Webex does.
+"""
+
+import argparse
+import datetime
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, urlencode
+
+
+BOT_EMAIL = 'bot@example.com'
+
+
+class rate_window:
+    """At most `rate` calls in any one second window (None: unlimited)"""
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.window = 0
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        if not self.rate:
+            return True
+
+        with self.lock:
+            now = int(time.monotonic())
+            if now != self.window:
+                self.window = now
+                self.calls = 0
+
+            self.calls += 1
+            return self.calls <= self.rate
+
+
+class webex_store:
+    def __init__(self, room_titles, list_rate=None, create_rate=None,
+                 retry_after=1):
+        self.rooms = {
+            f'room-{idx}': title for idx, title in enumerate(room_titles)
+        }
+
+        # Commands for the bot per room, oldest first, and every message
+        self.commands = {room_id: list() for room_id in self.rooms}
+        self.positions = dict()
+        self.messages = dict()
+        self.count = 0
+        self.last_created = None
+
+        # Replies (parentId -> arrival times) for the load test to collect
+        self.replies = dict()
+        self.reply_texts = dict()
+        self.calls = Counter()
+
+        self.list_limit = rate_window(list_rate)
+        self.create_limit = rate_window(create_rate)
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+
+    def room_id(self, title):
+        for room_id, room_title in self.rooms.items():
+            if room_title == title:
+                return room_id
+        return None
+
+    def _created(self):
+        # Strictly increasing, the poller compares created times
+        now = datetime.datetime.utcnow()
+        if self.last_created and now <= self.last_created:
+            now = self.last_created + datetime.timedelta(microseconds=1)
+        self.last_created = now
+        return now.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+    def _message(self, room_id, text, email, parent_id=None):
+        self.count += 1
+        message = {
+            'id': f'msg-{self.count:012d}',
+            'roomId': room_id,
+            'roomType': 'group',
+            'text': text,
+            'personId': 'person',
+            'personEmail': email,
+            'created': self._created(),
+        }
+        if parent_id:
+            message['parentId'] = parent_id
+        self.messages[message['id']] = message
+        return message
+
+    def post_command(self, room_id, text, email='user@example.com'):
+        """A user mentions the bot, returns the message"""
+        with self.lock:
+            message = self._message(room_id, text, email)
+            self.positions[message['id']] = len(self.commands[room_id])
+            self.commands[room_id].append(message)
+            return message
+
+    def list_commands(self, room_id, limit, before=None):
+        with self.lock:
+            commands = self.commands.get(room_id, list())
+            end = self.positions.get(before, len(commands))
+            page = commands[max(0, end - limit):end]
+            page.reverse()
+            return page, end - limit > 0
+
+    def reply(self, room_id, text, parent_id=None):
+        with self.lock:
+            message = self._message(room_id, text, BOT_EMAIL, parent_id)
+            if parent_id:
+                self.replies.setdefault(parent_id, list()).append(
+                    time.monotonic()
+                )
+                self.reply_texts.setdefault(parent_id, text)
+            return message
+
+
+class webex_handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def too_many_requests(self):
+        store = self.server.store
+        store.calls['429'] += 1
+        self.send_json(
+            {'message': 'Too Many Requests'}, 429,
+            {'Retry-After': str(store.retry_after)}
+        )
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'null')
+
+    def do_GET(self):
+        store = self.server.store
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if url.path == '/v1/rooms':
+            store.calls['rooms.list'] += 1
+            return self.send_json({'items': [
+                {'id': room_id, 'title': title, 'type': 'group'}
+                for room_id, title in store.rooms.items()
+            ]})
+
+        if url.path.startswith('/v1/rooms/'):
+            store.calls['rooms.get'] += 1
+            room_id = url.path[len('/v1/rooms/'):]
+            if room_id not in store.rooms:
+                return self.send_json({'message': 'Not Found'}, 404)
+            return self.send_json(
+                {'id': room_id, 'title': store.rooms[room_id], 'type': 'group'}
+            )
+
+        if url.path == '/v1/messages':
+            store.calls['messages.list'] += 1
+            if not store.list_limit.allow():
+                return self.too_many_requests()
+
+            page, more = store.list_commands(
+                query.get('roomId'), int(query.get('max', 50)),
+                query.get('beforeMessage')
+            )
+
+            headers = dict()
+            if more and page:
+                params = dict(query, beforeMessage=page[-1]['id'])
+                host = self.headers.get('Host')
+                headers['Link'] = \
+                    f'<http://{host}/v1/messages?{urlencode(params)}>; rel="next"'
+            return self.send_json({'items': page}, headers=headers)
+
+        if url.path.startswith('/v1/messages/'):
+            store.calls['messages.get'] += 1
+            message = store.messages.get(url.path[len('/v1/messages/'):])
+            if message is None:
+                return self.send_json({'message': 'Not Found'}, 404)
+            return self.send_json(message)
+
+        if url.path == '/v1/people/me':
+            store.calls['people.me'] += 1
+            return self.send_json(
+                {'id': 'bot', 'emails': [BOT_EMAIL], 'displayName': 'Lab'}
+            )
+
+        return self.send_json({'message': 'Not Found'}, 404)
+
+    def do_POST(self):
+        store = self.server.store
+        payload = self.read_json()
+
+        if self.path == '/v1/messages':
+            store.calls['messages.create'] += 1
+            if not store.create_limit.allow():
+                return self.too_many_requests()
+
+            return self.send_json(store.reply(
+                payload.get('roomId'),
+                payload.get('text') or payload.get('markdown'),
+                payload.get('parentId')
+            ))
+
+        return self.send_json({'message': 'Not Found'}, 404)
+
+
+def make_server(host='127.0.0.1', port=0, room_titles=('Lab',),
+                list_rate=None, create_rate=None, retry_after=1):
+    server = ThreadingHTTPServer((host, port), webex_handler)
+    server.daemon_threads = True
+    server.store = webex_store(
+        room_titles, list_rate, create_rate, retry_after
+    )
+    return server
+
+
+def main():
+    args = argparse.ArgumentParser()
+    args.add_argument('--host', default='127.0.0.1')
+    args.add_argument('--port', type=int, default=7100)
+    args.add_argument('--rooms', default='Lab')
+    args.add_argument('--list-rate', type=int, default=None)
+    args.add_argument('--create-rate', type=int, default=None)
+    opts = args.parse_args()
+
+    server = make_server(
+        opts.host, opts.port, opts.rooms.split(';'),
+        opts.list_rate, opts.create_rate
+    )
+    print(f'Fake Webex API on port {server.server_port}')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Run several buffer.py lease consumers (separate processes) against the
+fake buffer service and check every entry is handled exactly once, with
+one consumer crashing mid-batch to exercise lease expiry.
+
+    python benchmarks/lease_consumers.py [--consumers 4] [--backlog 2000]
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'poller'))
+sys.path.insert(0, HERE)
+
+import fake_buffer  # noqa: E402
+
+
+class collected_replies:
+    def __init__(self):
+        self.ids = list()
+        self.depth = 0
+
+    def put(self, room_id, text, parent_id=None):
+        self.ids.append(parent_id)
+
+
+def consumer(url, name, batch_size, visibility, crash_after, results):
+    import requests
+    import buffer
+
+    # Quiet the per-batch printing from handle_commands
+    buffer.print = lambda *args, **kwargs: None
+
+    session = requests.Session()
+    batches = 0
+
+    def dispatch(list_of_cmds):
+        # A crashing consumer dies holding its lease, never acknowledging
+        if crash_after and batches >= crash_after:
+            os._exit(1)
+        time.sleep(0.01)
+        return [(id, 'ok') for (id, msg, email) in list_of_cmds]
+
+    # Keep trying until idle for longer than a lease, so entries from the
+    # crashed consumer get picked up once its lease expires
+    idle_since = time.monotonic()
+    while time.monotonic() - idle_since < 2 * visibility:
+        replies = collected_replies()
+        claimed = buffer.consume_leased_batch(
+            url, session, name, ['room'], dispatch, replies,
+            batch_size, visibility
+        )
+
+        if not claimed:
+            time.sleep(0.1)
+            continue
+
+        batches += 1
+        idle_since = time.monotonic()
+        results.put((name, replies.ids))
+
+    results.put((name, None))
+
+
+def main():
+    args = argparse.ArgumentParser()
+    args.add_argument('--consumers', type=int, default=4)
+    args.add_argument('--backlog', type=int, default=2000)
+    args.add_argument('--batch-size', type=int, default=50)
+    args.add_argument('--visibility', type=float, default=2.0)
+    opts = args.parse_args()
+
+    server = fake_buffer.make_server(backlog=opts.backlog, room_id='room')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}'
+
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(
+            target=consumer,
+            args=(url, f'consumer{idx}', opts.batch_size, opts.visibility,
+                  3 if idx == 0 else 0, results)
+        )
+        for idx in range(opts.consumers)
+    ]
+
+    start = time.monotonic()
+    for process in processes:
+        process.start()
+
+    # Every consumer but the crashing one reports when it is done
+    handled = Counter()
+    per_consumer = Counter()
+    finished = 0
+    while finished < opts.consumers - 1:
+        name, ids = results.get()
+        if ids is None:
+            finished += 1
+            continue
+        handled.update(ids)
+        per_consumer[name] += len(ids)
+
+    for name, count in sorted(per_consumer.items()):
+        print(f'{name}: {count} entries')
+
+    for process in processes:
+        process.join()
+    elapsed = time.monotonic() - start
+
+    duplicates = sum(count - 1 for count in handled.values() if count > 1)
+    print(
+        f'{len(handled)}/{opts.backlog} entries handled in {elapsed:.2f}s, '
+        f'{duplicates} duplicates, {server.store.redelivered} redelivered '
+        f'after lease expiry, {len(server.store.entries)} left'
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+End-to-end load test: run poller.py or buffer.py against local stand-ins
+for Webex, the buffer service and the conductor, post commands at a fixed
+rate and measure how quickly the replies come back.
+
+    python benchmarks/load_test.py --target poller --rate 5 --duration 30
+    python benchmarks/load_test.py --target buffer --mode batch --rate 50 \\
+        --conductor-latency 50 --conductor-errors 0.01 --create-rate 20
+
+Reports messages/second, command-to-reply latency percentiles, Webex and
+conductor calls per command, 429s and the peak RSS of the service.
+Fails if Webex sent 429s but the service's poller_rate_limits_total
+counter (scraped from its metrics port) stayed at zero.
+Commands come from --users distinct emails; replies from the per-user
+throttle are counted separately and left out of the latencies.
+Extra service settings can be passed through the environment (e.g.
+COMMAND_CONCURRENCY=8).
+"""
+
+import argparse
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import fake_buffer  # noqa: E402
+import fake_conductor  # noqa: E402
+import fake_webex  # noqa: E402
+
+
+# Read-heavy mix of commands, as seen in the lab rooms
+read_commands = [
+    'Lab project list',
+    'Lab project list project{n}',
+    'Lab scenario list',
+    'Lab scenario list scenario{n}-0',
+    'Lab reserve list',
+    'Lab reserve list project{n}',
+    'Lab help',
+]
+
+write_commands = [
+    'Lab reserve project project{n} for 2 hours',
+    'Lab reserve cancel project{n}',
+]
+
+# Start of the fairness.THROTTLE_REPLY text
+THROTTLE_PREFIX = 'You are sending commands faster than'
+
+
+def start(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def scrape_counter(url, name):
+    """Sum of every labelled series of a counter on a /metrics page"""
+    try:
+        with urllib.request.urlopen(url, timeout=5) as response:
+            text = response.read().decode()
+    except OSError:
+        return None
+
+    return sum(
+        float(line.rsplit(' ', 1)[1]) for line in text.splitlines()
+        if line.startswith((f'{name}{{', f'{name} '))
+    )
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[idx]
+
+
+def wait_for(check, timeout, process):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if check():
+            return True
+        if process.poll() is not None:
+            raise SystemExit(f'Service exited early ({process.returncode})')
+        time.sleep(0.05)
+    return False
+
+
+def main():
+    args = argparse.ArgumentParser()
+    args.add_argument('--target', choices=['poller', 'buffer'],
+                      default='poller')
+    args.add_argument('--mode', default='poll',
+                      help='BUFFER_MODE for --target buffer')
+    args.add_argument('--rate', type=float, default=5.0,
+                      help='commands per second, across all rooms')
+    args.add_argument('--duration', type=float, default=30.0)
+    args.add_argument('--drain', type=float, default=30.0,
+                      help='seconds to wait for the last replies')
+    args.add_argument('--rooms', type=int, default=1)
+    args.add_argument('--writes', type=float, default=0.1,
+                      help='fraction of reserve/cancel commands')
+    args.add_argument('--projects', type=int, default=20)
+    args.add_argument('--users', type=int, default=50,
+                      help='distinct emails the commands are spread over')
+    args.add_argument('--conductor-latency', type=float, default=10,
+                      help='ms')
+    args.add_argument('--conductor-jitter', type=float, default=10,
+                      help='ms')
+    args.add_argument('--conductor-errors', type=float, default=0.0)
+    args.add_argument('--list-rate', type=int, default=None,
+                      help='messages.list calls/second before 429s')
+    args.add_argument('--create-rate', type=int, default=None,
+                      help='messages.create calls/second before 429s')
+    args.add_argument('--interval', default='1',
+                      help='WEBEX_TEAMS_POLLING_INTERVAL')
+    args.add_argument('--seed', type=int, default=1)
+    opts = args.parse_args()
+
+    random.seed(opts.seed)
+    titles = [f'Load room {idx}' for idx in range(opts.rooms)]
+
+    webex = fake_webex.make_server(
+        room_titles=titles, list_rate=opts.list_rate,
+        create_rate=opts.create_rate
+    )
+    conductor = fake_conductor.make_server(
+        latency=opts.conductor_latency / 1000.0,
+        jitter=opts.conductor_jitter / 1000.0,
+        error_rate=opts.conductor_errors, projects=opts.projects
+    )
+    buffer = fake_buffer.make_server()
+
+    webex_url = start(webex)
+    start(conductor)
+    start(buffer)
+    room_ids = [webex.store.room_id(title) for title in titles]
+
+    # The poller starts from the newest message, so give it one
+    for room_id in room_ids:
+        webex.store.post_command(room_id, 'Lab help')
+
+    metrics_port = free_port()
+    env = dict(
+        os.environ,
+        WEBEX_TEAMS_ACCESS_TOKEN='load-test',
+        WEBEX_TEAMS_BASE_URL=f'{webex_url}/v1/',
+        WEBEX_TEAMS_ROOM_TITLES=';'.join(titles),
+        WEBEX_TEAMS_POLLING_INTERVAL=opts.interval,
+        CONDUCTOR_HOST='127.0.0.1',
+        CONDUCTOR_PORT=str(conductor.server_port),
+        BUFFER_HOST='127.0.0.1',
+        BUFFER_PORT=str(buffer.server_port),
+        BUFFER_MODE=opts.mode,
+        METRICS_HOST='127.0.0.1',
+        METRICS_PORT=str(metrics_port),
+        PYTHONUNBUFFERED='1',
+    )
+    env.pop('POLLER_STATE_PATH', None)
+
+    script = os.path.join(HERE, '..', 'poller', f'{opts.target}.py')
+    stderr = tempfile.TemporaryFile()
+    process = subprocess.Popen(
+        [sys.executable, script], env=env,
+        stdout=subprocess.DEVNULL, stderr=stderr
+    )
+
+    # Ready once every room has been polled (poller) or the buffer has
+    # been asked for messages (buffer)
+    if opts.target == 'poller':
+        ready = wait_for(
+            lambda: webex.store.calls['messages.list'] >= opts.rooms, 30,
+            process
+        )
+    else:
+        ready = wait_for(lambda: buffer.store.requests > 0, 30, process)
+    if not ready:
+        process.kill()
+        raise SystemExit('Service did not start polling')
+
+    webex_before = sum(
+        count for (name, count) in webex.store.calls.items() if name != '429'
+    )
+    conductor_before = sum(
+        conductor.store.calls[method] for method in ('GET', 'POST', 'DELETE')
+    )
+
+    # Post commands at a steady rate, round robin over the rooms
+    posted = dict()
+    total = int(opts.rate * opts.duration)
+    start_time = time.monotonic()
+
+    for idx in range(total):
+        due = start_time + idx / opts.rate
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+        commands = write_commands \
+            if random.random() < opts.writes else read_commands
+        text = random.choice(commands).format(
+            n=random.randrange(opts.projects)
+        )
+        room_id = room_ids[idx % len(room_ids)]
+        email = f'user{idx % max(1, opts.users)}@example.com'
+
+        if opts.target == 'poller':
+            message = webex.store.post_command(room_id, text, email=email)
+            posted[message['id']] = time.monotonic()
+        else:
+            entry_id = f'entry-{idx:08d}'
+            buffer.store.add([{
+                'id': entry_id, 'roomId': room_id, 'text': text,
+                'email': email,
+            }])
+            posted[entry_id] = time.monotonic()
+
+    # Wait for the stragglers
+    wait_for(
+        lambda: all(id in webex.store.replies for id in posted), opts.drain,
+        process
+    )
+
+    # Every 429 the service got should be in its rate limit metric
+    rate_limits = scrape_counter(
+        f'http://127.0.0.1:{metrics_port}/metrics', 'poller_rate_limits_total'
+    )
+
+    process.terminate()
+    process.wait()
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform != 'darwin':
+        peak_rss *= 1024
+
+    # Throttled commands are answered right away without any work, keep
+    # them out of the latency and per-command numbers
+    throttled = {
+        id for id in posted
+        if webex.store.reply_texts.get(id, '').startswith(THROTTLE_PREFIX)
+    }
+    latencies = [
+        webex.store.replies[id][0] - posted_at
+        for id, posted_at in posted.items()
+        if id in webex.store.replies and id not in throttled
+    ]
+    replied = len(latencies)
+    last_reply = max(
+        (webex.store.replies[id][-1] for id in posted
+         if id in webex.store.replies), default=start_time
+    )
+    elapsed = max(1e-9, last_reply - start_time)
+
+    webex_calls = sum(
+        count for (name, count) in webex.store.calls.items() if name != '429'
+    ) - webex_before
+    conductor_calls = sum(
+        conductor.store.calls[method] for method in ('GET', 'POST', 'DELETE')
+    ) - conductor_before
+
+    label = opts.target if opts.target == 'poller' else \
+        f'{opts.target} ({opts.mode})'
+    print(f'{label}: {replied}/{total} commands answered in {elapsed:.1f}s '
+          f'({len(throttled)} throttled, {opts.users} users)')
+    print(f'  throughput     {replied / elapsed:8.2f} messages/s '
+          f'(offered {opts.rate:.2f})')
+    print(f'  latency p50    {percentile(latencies, 50) * 1000:8.0f} ms')
+    print(f'  latency p95    {percentile(latencies, 95) * 1000:8.0f} ms')
+    print(f'  latency p99    {percentile(latencies, 99) * 1000:8.0f} ms')
+    answered = max(1, replied + len(throttled))
+    print(f'  webex calls    {webex_calls / answered:8.2f} per command '
+          f'({webex.store.calls["429"]} x 429)')
+    print(f'  conductor      {conductor_calls / max(1, replied):8.2f} per '
+          f'command ({conductor.store.calls["500"]} x 500)')
+    print(f'  rate limits    {rate_limits or 0:8.0f} counted by the service')
+    print(f'  peak RSS       {peak_rss / 1048576:8.1f} MiB')
+
+    if replied + len(throttled) < total:
+        stderr.seek(0)
+        errors = stderr.read().decode(errors='replace')
+        if errors:
+            print('Service stderr (tail):')
+            print(errors[-2000:])
+
+    if webex.store.calls['429'] and not rate_limits:
+        raise SystemExit(
+            f'{webex.store.calls["429"]} x 429 sent, but poller_rate_limits_total '
+            f'reported {rate_limits}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Per-command validation cost of service.models: the previous validators.url
+check against the precompiled path-segment check, and validated parsing of
+conductor responses against the trusted construct() fast path.
+
+    python benchmarks/validation.py [--number 20000]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'poller'))
+
+import validators  # noqa: E402
+from pydantic import validator  # noqa: E402
+
+from service import models  # noqa: E402
+
+
+def legacy_valid_url_path(param: str) -> str:
+    if not param.islower():
+        raise ValueError("name must be valid URL path, must be lowercase")
+    if not validators.url(f'http://localhost/{param}'):
+        raise ValueError("name must be a valid URL path, URL path invalid")
+    return param
+
+
+class LegacyProjectInput(models.Project):
+    _name_is_valid_url = validator(
+        'name', allow_reuse=True
+    )(legacy_valid_url_path)
+
+
+class LegacyReservationInput(models.ReservationCore):
+    _project_is_valid_url = validator(
+        'project', allow_reuse=True
+    )(legacy_valid_url_path)
+
+    duration: int
+
+
+def report(name, before, after, number):
+    print(
+        f'{name:>28}: {before / number * 1e6:8.2f} us -> '
+        f'{after / number * 1e6:8.2f} us  ({before / after:5.1f}x)'
+    )
+
+
+def main():
+    args = argparse.ArgumentParser()
+    args.add_argument('--number', type=int, default=20000)
+    opts = args.parse_args()
+    number = opts.number
+
+    # A handful of names, as in a real batch where the same projects repeat
+    names = ['vxlan-evpn-core', 'vpc-bgw-as-dci', 'srv6-core', 'lab-one']
+    project = {
+        'name': 'vxlan-evpn-core',
+        'title': 'VXLAN EVPN Multisite Core Technologies',
+        'description': 'An environment to demonstrate VXLAN EVPN.',
+    }
+    reservation = {
+        'project': 'vxlan-evpn-core', 'email': 'user@example.com',
+        'ttl': 7200, 'id': 42,
+    }
+
+    report(
+        'valid_url_path',
+        timeit.timeit(
+            lambda: [legacy_valid_url_path(name) for name in names],
+            number=number
+        ) / len(names),
+        timeit.timeit(
+            lambda: [models.valid_url_path(name) for name in names],
+            number=number
+        ) / len(names),
+        number
+    )
+
+    report(
+        'ProjectInput',
+        timeit.timeit(lambda: LegacyProjectInput(**project), number=number),
+        timeit.timeit(lambda: models.ProjectInput(**project), number=number),
+        number
+    )
+
+    reservation_input = {
+        'project': 'vxlan-evpn-core', 'email': 'user@example.com',
+        'duration': 7200,
+    }
+    report(
+        'ReservationInput',
+        timeit.timeit(
+            lambda: LegacyReservationInput(**reservation_input), number=number
+        ),
+        timeit.timeit(
+            lambda: models.ReservationInput(**reservation_input), number=number
+        ),
+        number
+    )
+
+    report(
+        'Reservation response',
+        timeit.timeit(
+            lambda: models.Reservation(**reservation), number=number
+        ),
+        timeit.timeit(
+            lambda: models.trusted(models.Reservation, reservation),
+            number=number
+        ),
+        number
+    )
+
+
+if __name__ == '__main__':
+    main()
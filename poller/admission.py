@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Admission control for command batches
+
+A batch bigger than `max_pending` (a catch-up after a restart, a backlog
+built up while the conductor was slow) is trimmed before it is run: the
+oldest read-only commands are shed first and answered with a short busy
+reply, commands that change state are always admitted.  That keeps the
+time to work through a batch bounded instead of replying to a stale flood.
+"""
+
+import parser
+
+
+SHED_REPLY = 'The service is busy and skipped this command, please try again.'
+
+
+class admission_queue:
+    def __init__(self, max_pending=50, is_read_only=parser.is_read_only):
+        self.max_pending = int(max_pending)
+        self.is_read_only = is_read_only
+        self.shed = 0
+
+    def admit(self, list_of_cmds):
+        """
+        Split (id, msg, email) triplets into (admitted, shed), both in
+        message order
+        """
+
+        excess = len(list_of_cmds) - self.max_pending
+        if self.max_pending <= 0 or excess <= 0:
+            return list_of_cmds, list()
+
+        admitted = list()
+        shed = list()
+
+        # Batches are oldest first, so the oldest reads go first
+        for cmd in list_of_cmds:
+            if excess > 0 and self.is_read_only(cmd[1]):
+                shed.append(cmd)
+                excess -= 1
+            else:
+                admitted.append(cmd)
+
+        self.shed += len(shed)
+        return admitted, shed
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Circuit breakers for the conductor endpoint groups
+
+After `failures` consecutive failed calls to an endpoint group the circuit
+opens and calls fail fast for `reset_timeout` seconds.  Then a single probe
+call is let through (half open): success closes the circuit, failure opens
+it again for another `reset_timeout`.
+"""
+
+import threading
+import time
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class circuit_breaker:
+    def __init__(self, failures=5, reset_timeout=30.0, clock=time.monotonic):
+        self.failures = max(1, int(failures))
+        self.reset_timeout = float(reset_timeout)
+        self.clock = clock
+
+        self.state = CLOSED
+        self.opened = 0
+
+        self._failed = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """May a call go ahead?  Every allowed call must be record()ed"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+
+            if self.state == OPEN:
+                if self.clock() - self._opened_at < self.reset_timeout:
+                    return False
+                self.state = HALF_OPEN
+
+            # Half open: one probe at a time
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record(self, success):
+        with self._lock:
+            self._probing = False
+
+            if success:
+                self.state = CLOSED
+                self._failed = 0
+                return
+
+            self._failed += 1
+            if self.state == HALF_OPEN or self._failed >= self.failures:
+                if self.state != OPEN:
+                    self.opened += 1
+                self.state = OPEN
+                self._opened_at = self.clock()
+
+    def retry_in(self):
+        """Seconds until the next probe is allowed (0 unless open)"""
+        with self._lock:
+            if self.state != OPEN:
+                return 0.0
+            return max(
+                0.0, self.reset_timeout - (self.clock() - self._opened_at)
+            )
+
+
+class breaker_group:
+    """One circuit_breaker per URL prefix, longest prefix wins"""
+
+    def __init__(self, prefixes, failures=5, reset_timeout=30.0,
+                 clock=time.monotonic):
+        self.breakers = {
+            prefix: circuit_breaker(failures, reset_timeout, clock)
+            for prefix in prefixes
+        }
+        self._prefixes = sorted(self.breakers, key=len, reverse=True)
+
+    def for_url(self, url):
+        for prefix in self._prefixes:
+            if url.startswith(prefix):
+                return prefix, self.breakers[prefix]
+        return None, None
+
+    def stats(self):
+        return {
+            prefix: breaker.state for prefix, breaker in self.breakers.items()
+        }
@@ -1,62 +1,384 @@
 #!/usr/bin/env python3
 
 
+import json
+import os
+import queue
+import threading
+import traceback
+from contextlib import contextmanager
 from os import environ
-from time import sleep
+from time import sleep, perf_counter
 
 import requests
-from webexteamssdk import WebexTeamsAPI
-from webexteamssdk.models.immutable import Room
 
+import engine
 import parser
-import library
+import metrics
+import startup
+import tracing
 
 
-def get_buffer_messages(base_url):
+def fetch_buffer_entries(base_url, session=None):
     url = f'{base_url}/messages/'
 
-    response = requests.get(url)
-    if response.status_code == 404:
-        # This is okay in our environment. No messages found.
-        return list()
-    else:
-        # Fail for other status_codes
+    with tracing.span('fetch', source='buffer') as span:
+        response = (session or requests).get(url)
+        if response.status_code == 404:
+            # This is okay in our environment. No messages found.
+            return list()
+        else:
+            # Fail for other status_codes
+            response.raise_for_status()
+
+        entries = response.json()
+        span.attach(e['id'] for e in entries)
+
+    return entries
+
+
+def group_by_room(entries, room_ids):
+    """
+    Returns (commands, rooms): the (id, text, email) triplets for all the
+    rooms we serve and a map of message ID to room ID for the replies.
+
+    Entries without a roomId belong to the first room, entries for rooms
+    we don't serve are ignored.
+    """
+
+    results = list()
+    message_rooms = dict()
+
+    for e in entries:
+        room_id = e.get('roomId', room_ids[0])
+        if room_id not in room_ids:
+            continue
+
+        results.append((e['id'], e['text'], e['email']))
+        message_rooms[e['id']] = room_id
+        tracing.received(e['id'], e.get('created'))
+
+    return results, message_rooms
+
+
+def get_buffer_messages_by_room(base_url, room_ids, session=None):
+    return group_by_room(fetch_buffer_entries(base_url, session), room_ids)
+
+
+def decode_stream_line(line):
+    """
+    Decode one line of the buffer message stream: either NDJSON (one JSON
+    entry per line) or server-sent events ("data: {...}").  Returns None
+    for blank lines, SSE comments/fields and keep-alives.
+    """
+
+    # requests only decodes lines when the response declares a charset
+    if isinstance(line, bytes):
+        line = line.decode('utf-8')
+
+    line = line.strip()
+    if not line or line.startswith(':'):
+        return None
+
+    if line.startswith('data:'):
+        line = line[5:].strip()
+    elif line[0] not in '{[':
+        # Other SSE fields (event:, id:, retry:)
+        return None
+
+    entry = json.loads(line)
+    return entry if isinstance(entry, dict) else None
+
+
+def stream_buffer_entries(base_url, session, path='/messages/stream',
+                          idle_timeout=60):
+    """
+    Hold a streaming request open and yield entries as they arrive, one
+    line at a time rather than decoding a whole JSON document.  Returns
+    when the server closes the stream.
+    """
+
+    url = f'{base_url}{path}'
+    headers = {'Accept': 'application/x-ndjson, text/event-stream'}
+
+    with session.get(
+        url, stream=True, headers=headers, timeout=(10, idle_timeout)
+    ) as response:
         response.raise_for_status()
 
-    results = [
-        (e['id'], e['text'], e['email'])
-        for e in response.json()
-    ]
+        for line in response.iter_lines(decode_unicode=True):
+            entry = decode_stream_line(line)
+            if entry is not None:
+                yield entry
 
-    return results
 
+def stream_reader(base_url, session, events, path='/messages/stream',
+                  idle_timeout=60, max_backoff=30):
+    """
+    Thread target: keep the stream open, reconnecting with backoff.  Every
+    disconnect, clean or not, waits before reconnecting (so a server that
+    ends streams at once is not hammered); the wait only resets once a
+    stream delivered entries.
+    """
+    backoff = 1
 
-def send_webex_responses(webex, room_id, msg_list):
-    for (parent_id, msg) in msg_list:
-        webex.messages.create(
-            roomId=room_id, parentId=parent_id, text=msg
+    while True:
+        received = False
+        try:
+            for entry in stream_buffer_entries(
+                base_url, session, path, idle_timeout
+            ):
+                events.put(entry)
+                received = True
+
+        except (requests.RequestException, ValueError) as err:
+            print(f'Buffer stream interrupted: {err}')
+
+        if received:
+            backoff = 1
+        sleep(backoff)
+        backoff = min(max_backoff, backoff * 2)
+
+
+def fetch_buffer_batch(base_url, session, limit, token=None):
+    """
+    Fetch one page of at most `limit` entries.  Returns (entries, token)
+    where token is the continuation for the next page (None when done).
+
+    A buffer service without paging returns a plain list, treated as a
+    single final page.
+    """
+
+    params = {'limit': int(limit)}
+    if token:
+        params['cursor'] = token
+
+    with tracing.span('fetch', source='buffer') as span:
+        response = session.get(f'{base_url}/messages/', params=params)
+        if response.status_code == 404:
+            # This is okay in our environment. No messages found.
+            return list(), None
+        else:
+            # Fail for other status_codes
+            response.raise_for_status()
+
+        payload = response.json()
+        if isinstance(payload, list):
+            payload = {'messages': payload}
+
+        entries = payload.get('messages', list())
+        span.attach(e['id'] for e in entries)
+
+    return entries, payload.get('next')
+
+
+def ack_buffer_messages(base_url, session, message_ids):
+    """Tell the buffer service these entries are done (bulk acknowledge)"""
+    if not message_ids:
+        return
+
+    response = session.post(
+        f'{base_url}/messages/ack', json={'ids': list(message_ids)}
+    )
+    response.raise_for_status()
+
+
+def drain_buffer(base_url, session, room_ids, dispatch, replies, limit=100):
+    """
+    Work through the buffer one page at a time until it is empty.  Each
+    page is acknowledged only after its replies are queued, so a crash
+    part way through gets the unacknowledged pages redelivered.  Returns
+    the number of entries handled.
+    """
+
+    token = None
+    handled = 0
+
+    while True:
+        entries, token = fetch_buffer_batch(base_url, session, limit, token)
+        if not entries:
+            return handled
+
+        command_message_list, message_rooms = group_by_room(entries, room_ids)
+        handle_commands(dispatch, replies, command_message_list, message_rooms)
+
+        # Entries for rooms we don't serve are acknowledged too, otherwise
+        # every drain would fetch them again
+        ack_buffer_messages(base_url, session, [e['id'] for e in entries])
+        handled += len(command_message_list)
+
+        if not token:
+            return handled
+
+
+def claim_buffer_batch(base_url, session, consumer, limit, visibility):
+    """
+    Lease up to `limit` entries for `visibility` seconds.  Other consumers
+    don't see them until the lease is acknowledged, released or expires.
+    Returns (lease ID, entries).
+    """
+
+    with tracing.span('fetch', source='buffer', consumer=consumer) as span:
+        response = session.post(
+            f'{base_url}/messages/lease',
+            json={'consumer': consumer, 'limit': int(limit),
+                  'visibility': float(visibility)}
         )
+        if response.status_code == 404:
+            # This is okay in our environment. No messages found.
+            return None, list()
+        else:
+            response.raise_for_status()
 
+        payload = response.json()
+        entries = payload.get('messages', list())
+        span.attach(e['id'] for e in entries)
 
-def get_webex_room_id(webex, room_title):
-    # Get roomID for the room
-    room_list: list(Room) = webex.rooms.list()
+    return payload.get('lease'), entries
 
-    # Search through the list to find all room IDs that match the title
-    all_room_ids = [
-        room.id
-        for room in room_list
-        if room.title == room_title
-    ]
 
-    # We should only find one (application requiremes unique titles)
-    if len(all_room_ids) > 1:
-        raise Exception(
-                        f'Duplicate rooms found for {room_title}',
-                        list(room_list)
-                        )
+def renew_lease(base_url, session, lease_id, visibility):
+    response = session.post(
+        f'{base_url}/messages/lease/{lease_id}/renew',
+        json={'visibility': float(visibility)}
+    )
+    response.raise_for_status()
+
+
+def lease_lost(response, lease_id):
+    """
+    A 404/409 means the lease expired and the entries went back to the
+    buffer (another consumer may have them now): log it, don't crash
+    """
+    if response.status_code in (404, 409):
+        print(f'Lease {lease_id} was lost ({response.status_code})')
+        return True
+
+    response.raise_for_status()
+    return False
 
-    return all_room_ids[0] if len(all_room_ids) else 0
+
+def ack_lease(base_url, session, lease_id, message_ids):
+    response = session.post(
+        f'{base_url}/messages/lease/{lease_id}/ack',
+        json={'ids': list(message_ids)}
+    )
+    return not lease_lost(response, lease_id)
+
+
+def release_lease(base_url, session, lease_id):
+    """Hand the entries back for another consumer, e.g. after an error"""
+    response = session.post(f'{base_url}/messages/lease/{lease_id}/release')
+    return not lease_lost(response, lease_id)
+
+
+@contextmanager
+def lease_renewal(base_url, lease_id, visibility):
+    """Renew the lease every third of its visibility while the block runs"""
+    done = threading.Event()
+    session = requests.Session()
+
+    def renew():
+        while not done.wait(visibility / 3.0):
+            try:
+                renew_lease(base_url, session, lease_id, visibility)
+            except requests.RequestException as err:
+                print(f'Failed to renew lease {lease_id}: {err}')
+
+    thread = threading.Thread(target=renew, name='lease-renew', daemon=True)
+    thread.start()
+
+    try:
+        yield
+    finally:
+        done.set()
+        thread.join()
+        session.close()
+
+
+def consume_leased_batch(
+    base_url, session, consumer, room_ids, dispatch, replies,
+    limit=100, visibility=30, failures=None, max_attempts=3
+):
+    """
+    Claim one leased batch, process it while keeping the lease alive, then
+    acknowledge it.  On failure the error is logged and the lease released
+    so the entries are redelivered; entries that failed `max_attempts`
+    times here are acknowledged instead (dead-lettered), so a poison entry
+    cannot keep failing batches.  `failures` holds the per-entry counts
+    between calls.  Returns the number of entries in the batch.
+    """
+
+    if failures is None:
+        failures = dict()
+
+    lease_id, entries = claim_buffer_batch(
+        base_url, session, consumer, limit, visibility
+    )
+    if not entries:
+        return 0
+
+    entry_ids = [e['id'] for e in entries]
+
+    try:
+        with lease_renewal(base_url, lease_id, visibility):
+            command_message_list, message_rooms = group_by_room(
+                entries, room_ids
+            )
+            handle_commands(
+                dispatch, replies, command_message_list, message_rooms
+            )
+    except Exception:
+        traceback.print_exc()
+
+        for id in entry_ids:
+            failures[id] = failures.get(id, 0) + 1
+
+        # Entries another replica finished are never seen again here
+        while len(failures) > 10000:
+            del failures[next(iter(failures))]
+        poison = [id for id in entry_ids if failures[id] >= max_attempts]
+
+        if poison:
+            print(f'Dead-lettering {len(poison)} entries after '
+                  f'{max_attempts} failed attempts: {poison}')
+            ack_lease(base_url, session, lease_id, poison)
+            for id in poison:
+                del failures[id]
+
+        if len(poison) < len(entry_ids):
+            release_lease(base_url, session, lease_id)
+        return len(entries)
+
+    for id in entry_ids:
+        failures.pop(id, None)
+
+    # Entries for rooms we don't serve are acknowledged too: every replica
+    # sharing a buffer is expected to serve the same rooms
+    ack_lease(base_url, session, lease_id, entry_ids)
+    return len(entries)
+
+
+def handle_commands(dispatch, replies, command_message_list, message_rooms):
+    print(command_message_list)
+    metrics.poll_messages.observe(len(command_message_list), source='buffer')
+
+    # Parse those messages (all rooms in one batch), send to the backend
+    # and queue the replies to the room each message came from.  A failed
+    # batch is still answered, so it is acknowledged and not redelivered
+    try:
+        response_message = dispatch(command_message_list)
+    except Exception as err:
+        print(f'Buffer batch failed: {err!r}')
+        response_message = [
+            (id, parser.COMMAND_ERROR) for (id, msg, email) in
+            command_message_list
+        ]
+    for (id, response) in response_message:
+        replies.put(message_rooms[id], response, parent_id=id)
+
+    if replies.depth:
+        print(f'Reply queue depth: {replies.depth}')
 
 
 def initialization():
@@ -69,51 +391,81 @@ def initialization():
     # Polling interval?
     buffer_interval = environ.get('WEBEX_TEAMS_POLLING_INTERVAL', '5')
 
-    # Which room are we monitoring?
-    webex_room_title = environ.get('WEBEX_TEAMS_ROOM_TITLE')
-    if not webex_room_title:
-        raise Exception('WEBEX_TEAMS_ROOM_TITLE env var is required.')
-
-    # Make sure our secure token is loaded
-    if not environ.get('WEBEX_TEAMS_ACCESS_TOKEN'):
-        raise Exception('WEBEX_TEAMS_ACCESS_TOKEN env var is required.')
+    webex = startup.webex_api()
+    webex_room_ids = [
+        room_id for (title, room_id) in startup.webex_rooms(webex)
+    ]
 
-    # Load up WebexTeams API instance
-    webex = WebexTeamsAPI(wait_on_rate_limit=True)
+    conductor = startup.conductor_service()
 
-    # Does the room exist?
-    webex_room_id = get_webex_room_id(webex, webex_room_title)
-    if webex_room_id == 0:
-        raise Exception('Room "{webex_room_title}" not found.')
+    return buffer_url, int(buffer_interval), conductor, webex, webex_room_ids
 
-    # Check for conductor service environment variables, else default
-    svc_proto = environ.get('CONDUCTOR_PROTO', 'http')
-    svc_host = environ.get('CONDUCTOR_HOST', 'localhost')
-    svc_port = environ.get('CONDUCTOR_PORT', '8000')
 
-    conductor = library.conductor_service(
-        proto=svc_proto, host=svc_host, port=svc_port
-    )
+if __name__ == '__main__':
 
-    return buffer_url, int(buffer_interval), conductor, webex, webex_room_id
+    url, interval, conductor, webex, webex_room_ids = initialization()
 
+    dispatch = startup.batch_dispatcher(conductor)
+    replies = startup.reply_queue(webex)
+    startup.reservation_index(conductor, webex, webex_room_ids, replies)
+    startup.observability(replies, conductor)
 
-if __name__ == '__main__':
+    # One keep-alive session for every buffer service request
+    session = requests.Session()
 
-    url, interval, conductor, webex, webex_room_id = initialization()
+    # Streaming: dispatch entries as soon as the buffer service pushes them
+    if environ.get('BUFFER_MODE', 'poll') == 'stream':
+        events = queue.Queue()
+        reader = threading.Thread(
+            target=stream_reader,
+            args=(url, session, events),
+            kwargs={'path': environ.get('BUFFER_STREAM_PATH', '/messages/stream')},
+            name='buffer-stream', daemon=True
+        )
+        reader.start()
+
+        while True:
+            command_message_list, message_rooms = group_by_room(
+                engine.next_batch(events), webex_room_ids
+            )
+            handle_commands(
+                dispatch, replies, command_message_list, message_rooms
+            )
+
+    # Leases: compete with other replicas for batches of the buffer
+    if environ.get('BUFFER_MODE', 'poll') == 'lease':
+        batch_size = int(environ.get('BUFFER_BATCH_SIZE', '100'))
+        visibility = float(environ.get('BUFFER_LEASE_SECONDS', '30'))
+        consumer = f"{environ.get('HOSTNAME', 'buffer')}-{os.getpid()}"
+        attempts = int(environ.get('BUFFER_LEASE_ATTEMPTS', '3'))
+        failures = dict()
+
+        while True:
+            claimed = consume_leased_batch(
+                url, session, consumer, webex_room_ids, dispatch, replies,
+                batch_size, visibility, failures, attempts
+            )
+            if not claimed:
+                sleep(interval)
+
+    # Batches: page through the backlog, acknowledging each page
+    if environ.get('BUFFER_MODE', 'poll') == 'batch':
+        batch_size = int(environ.get('BUFFER_BATCH_SIZE', '100'))
+
+        while True:
+            drain_buffer(
+                url, session, webex_room_ids, dispatch, replies, batch_size
+            )
+            sleep(interval)
 
     # Let's poll (roadmap is to make this websocket)
     while True:
         # Get messages from WebEx Bot collecting webhooks
-        command_message_list = get_buffer_messages(url)
-        print(command_message_list)
-
-        # Parse those messages and send to the backend
-        response_message = parser.parse_command_list(
-            conductor, command_message_list
+        start = perf_counter()
+        command_message_list, message_rooms = get_buffer_messages_by_room(
+            url, webex_room_ids, session
         )
-
-        # Respond to the messages
-        send_webex_responses(webex, webex_room_id, response_message)
+        metrics.poll_seconds.observe(perf_counter() - start, source='buffer')
+        handle_commands(dispatch, replies, command_message_list, message_rooms)
 
         sleep(interval)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Read-through cache for conductor GET responses
+
+Entries expire per endpoint group (projects and scenarios rarely change,
+reservations do) and the cache is bounded with LRU eviction.  Writes to an
+endpoint group invalidate every cached entry of that group.  Once an entry
+has expired, validator_store lets the GET be revalidated instead of
+downloaded again.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+# Seconds a GET response stays valid, by URL prefix (longest prefix wins)
+default_ttls = {
+    '/version/': 3600,
+    '/project/': 300,
+    '/scenario/': 300,
+    '/reserve/project/': 15,
+}
+
+MISSING = object()
+
+
+class ttl_cache:
+    def __init__(self, ttls=None, max_entries=256, clock=time.monotonic):
+        self.ttls = dict(default_ttls if ttls is None else ttls)
+        self.max_entries = int(max_entries)
+        self.clock = clock
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # url -> (expires_at, payload), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Longest prefix first so /reserve/project/ beats a shorter match
+        self._prefixes = sorted(self.ttls, key=len, reverse=True)
+
+    def group(self, url):
+        for prefix in self._prefixes:
+            if url.startswith(prefix):
+                return prefix
+        return None
+
+    def get(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+
+            if entry is None or entry[0] <= self.clock():
+                if entry is not None:
+                    del self._entries[url]
+                self.misses += 1
+                return MISSING
+
+            self._entries.move_to_end(url)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, url, payload):
+        prefix = self.group(url)
+        if prefix is None or self.max_entries <= 0:
+            return
+
+        with self._lock:
+            self._entries[url] = (self.clock() + self.ttls[prefix], payload)
+            self._entries.move_to_end(url)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, url):
+        """Drop every entry in the same endpoint group as url"""
+        prefix = self.group(url)
+        if prefix is None:
+            return
+
+        with self._lock:
+            stale = [key for key in self._entries if self.group(key) == prefix]
+            for key in stale:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+            }
+
+
+class validator_store:
+    """
+    Last response body and validators (ETag, Last-Modified) per GET URL
+
+    Used for conditional requests: a 304 Not Modified answer is served
+    from the stored, already decoded payload.  Bounded with LRU eviction.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = int(max_entries)
+
+        self.revalidated = 0
+
+        # url -> (etag, last_modified, payload), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def headers(self, url):
+        """Conditional request headers for url ({} if nothing is stored)"""
+        with self._lock:
+            entry = self._entries.get(url)
+
+        if entry is None:
+            return dict()
+
+        etag, last_modified, _ = entry
+        headers = dict()
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def get(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                return MISSING
+
+            self._entries.move_to_end(url)
+            self.revalidated += 1
+            return entry[2]
+
+    def put(self, url, response, payload):
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if self.max_entries <= 0:
+            return
+
+        with self._lock:
+            if not (etag or last_modified):
+                self._entries.pop(url, None)
+                return
+
+            self._entries[url] = (etag, last_modified, payload)
+            self._entries.move_to_end(url)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Durable polling state: the room cursor and a journal of processed messages
+
+Stored in SQLite so a restarted pod resumes from the last handled message
+instead of skipping everything that arrived while it was down.  Writes are
+committed (and so fsync'd) in batches: once per poll via flush(), or every
+`sync_every` journal updates / `sync_interval` seconds from the reply
+threads.
+
+Journal states per message ID:
+    received  - fetched, command not finished yet (fetched and run again
+                on restart, the cursor is only saved after the batch)
+    processed - response computed but not sent yet (re-sent on restart)
+    sending   - chunked response being sent, too large to store (the
+                command is kept and run again on restart)
+    replied   - done, skipped if seen again
+    failed    - the reply could not be sent, given up on (not re-sent)
+
+Rows in every state are pruned by age.  Reservation expiry notices already
+sent are kept by lease ID.
+"""
+
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+
+# Newest message already handled: its ID plus its creation timestamp, so the
+# scan can still stop if that message was deleted from the room
+message_cursor = namedtuple('message_cursor', ['id', 'created'])
+
+RECEIVED = 'received'
+PROCESSED = 'processed'
+SENDING = 'sending'
+REPLIED = 'replied'
+FAILED = 'failed'
+
+
+class checkpoint_store:
+    def __init__(self, path, sync_every=20, sync_interval=1.0):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        self.sync_every = int(sync_every)
+        self.sync_interval = float(sync_interval)
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._synced = time.monotonic()
+
+        with self._lock:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=FULL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS cursor ('
+                ' room_id TEXT PRIMARY KEY, message_id TEXT, created TEXT)'
+            )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS journal ('
+                ' message_id TEXT PRIMARY KEY, room_id TEXT, status TEXT,'
+                ' response TEXT, updated REAL)'
+            )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS notices ('
+                ' lease_id TEXT PRIMARY KEY, updated REAL)'
+            )
+            self._db.commit()
+
+    # Cursor
+    def load_cursor(self, room_id):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT message_id, created FROM cursor WHERE room_id = ?',
+                (room_id,)
+            ).fetchone()
+
+        if not row:
+            return None
+
+        created = datetime.datetime.fromisoformat(row[1]) if row[1] else None
+        return message_cursor(row[0], created)
+
+    def save_cursor(self, room_id, cursor):
+        if not cursor:
+            return
+
+        created = cursor.created.isoformat() if cursor.created else None
+
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO cursor VALUES (?, ?, ?)',
+                (room_id, cursor.id, created)
+            )
+            self._pending += 1
+
+    # Journal
+    def record(self, room_id, message_id, status, response=None):
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, ?)',
+                (message_id, room_id, status, response, time.time())
+            )
+            self._pending += 1
+
+        self.maybe_flush()
+
+    def received(self, room_id, list_of_cmds):
+        # The command is kept in case its response cannot be stored
+        for (id, msg, email) in list_of_cmds:
+            self.record(room_id, id, RECEIVED, json.dumps([msg, email]))
+
+    def processed(self, room_id, list_of_responses):
+        for (id, response) in list_of_responses:
+            if isinstance(response, str):
+                self.record(room_id, id, PROCESSED, response)
+                continue
+
+            # Chunked responses are generated while they are sent, keep
+            # the command from received() to run again after a restart
+            with self._lock:
+                self._db.execute(
+                    'UPDATE journal SET status = ?, updated = ?'
+                    ' WHERE message_id = ?',
+                    (SENDING, time.time(), id)
+                )
+                self._pending += 1
+            self.maybe_flush()
+
+    def replied(self, room_id, message_id):
+        self.record(room_id, message_id, REPLIED)
+
+    def failed(self, room_id, message_id):
+        self.record(room_id, message_id, FAILED)
+
+    def status(self, message_id):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT status FROM journal WHERE message_id = ?',
+                (message_id,)
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def unfinished(self, list_of_cmds):
+        """Drop commands from a batch that already have a response"""
+        return [
+            cmd for cmd in list_of_cmds
+            if self.status(cmd[0]) not in (PROCESSED, SENDING, REPLIED, FAILED)
+        ]
+
+    def resend(self, room_id):
+        """(id, msg, email) commands whose chunked reply never finished"""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT message_id, response FROM journal'
+                ' WHERE room_id = ? AND status = ? ORDER BY updated',
+                (room_id, SENDING)
+            ).fetchall()
+
+        return [(row[0], *json.loads(row[1])) for row in rows if row[1]]
+
+    def unsent(self, room_id):
+        """(id, response) pairs computed before a restart but never sent"""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT message_id, response FROM journal'
+                ' WHERE room_id = ? AND status = ? ORDER BY updated',
+                (room_id, PROCESSED)
+            ).fetchall()
+
+        return [(row[0], row[1]) for row in rows]
+
+    def prune(self, max_age=7 * 24 * 3600):
+        """
+        Forget messages (whatever their state) and notices older than
+        max_age seconds, so nothing is retried or kept forever
+        """
+        with self._lock:
+            self._db.execute(
+                'DELETE FROM journal WHERE updated < ?',
+                (time.time() - max_age,)
+            )
+            self._db.execute(
+                'DELETE FROM notices WHERE updated < ?',
+                (time.time() - max_age,)
+            )
+            self._pending += 1
+
+    # Reservation expiry notices
+    def noticed(self, lease_id):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT 1 FROM notices WHERE lease_id = ?', (str(lease_id),)
+            ).fetchone()
+
+        return row is not None
+
+    def notice_sent(self, lease_id):
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO notices VALUES (?, ?)',
+                (str(lease_id), time.time())
+            )
+            self._pending += 1
+
+    # Batched commits
+    def maybe_flush(self):
+        if self._pending >= self.sync_every or \
+           time.monotonic() - self._synced >= self.sync_interval:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self._pending:
+                self._db.commit()
+            self._pending = 0
+            self._synced = time.monotonic()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._db.close()
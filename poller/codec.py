@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""
+JSON codec for conductor traffic
+
+Uses orjson when it is installed (several times faster to decode the
+growing list payloads), the standard library json module otherwise.
+Both take str or bytes and return the same Python objects.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if orjson is not None:
+    name = 'orjson'
+    loads = orjson.loads
+
+    def dumps(payload) -> bytes:
+        return orjson.dumps(payload)
+
+else:
+    name = 'json'
+    loads = json.loads
+
+    def dumps(payload) -> bytes:
+        return json.dumps(payload, separators=(',', ':')).encode()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Idempotency guard against redelivered messages
+
+Webex message IDs are ~104 character strings, so only 64-bit digests are
+kept: an exact LRU of the most recent digests plus a pair of rotating
+Bloom filters for everything older.  Memory stays fixed however many
+messages go through the process; the price is a configurable false
+positive rate (a new message wrongly treated as already seen).
+"""
+
+import hashlib
+import math
+import threading
+from collections import OrderedDict
+
+
+def digest(message_id):
+    """128-bit digest of a message ID as two 64-bit integers"""
+    raw = hashlib.blake2b(message_id.encode(), digest_size=16).digest()
+    return int.from_bytes(raw[:8], 'little'), int.from_bytes(raw[8:], 'little')
+
+
+class bloom_filter:
+    def __init__(self, capacity, error_rate=1e-6, max_bytes=None):
+        capacity = max(1, int(capacity))
+
+        # Optimal size and hash count for capacity entries at error_rate
+        bits = int(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        if max_bytes:
+            bits = min(bits, int(max_bytes) * 8)
+        bits = max(64, bits)
+
+        self.capacity = capacity
+        self.bits = bits
+        self.hashes = max(1, round(bits / capacity * math.log(2)))
+        self.count = 0
+        self._array = bytearray((bits + 7) // 8)
+
+    def _positions(self, digests):
+        # Double hashing: h1 + i * h2 gives `hashes` independent positions
+        h1, h2 = digests
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.bits
+
+    def add(self, digests):
+        for pos in self._positions(digests):
+            self._array[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, digests):
+        return all(
+            self._array[pos >> 3] & (1 << (pos & 7))
+            for pos in self._positions(digests)
+        )
+
+    @property
+    def memory_bytes(self):
+        return len(self._array)
+
+
+class duplicate_guard:
+    """
+    Remembers message IDs once they have been answered.  Two Bloom
+    generations of `capacity` entries each: when the current one is full
+    the older one is dropped, so at least the last `capacity` messages are
+    always remembered.
+    """
+
+    def __init__(
+        self, capacity=1000000, error_rate=1e-6, recent=10000, max_bytes=None
+    ):
+        self.capacity = int(capacity)
+        self.error_rate = float(error_rate)
+        self.recent_size = int(recent)
+
+        # Split the memory cap between the two Bloom generations
+        self._max_bytes = int(max_bytes) // 2 if max_bytes else None
+
+        self.duplicates = 0
+        self._recent = OrderedDict()
+        self._current = self._new_filter()
+        self._previous = None
+        self._lock = threading.Lock()
+
+    def _new_filter(self):
+        # Lookups check both generations, so each gets half the error budget
+        return bloom_filter(
+            self.capacity, self.error_rate / 2, self._max_bytes
+        )
+
+    def __contains__(self, message_id):
+        digests = digest(message_id)
+
+        with self._lock:
+            if digests in self._recent:
+                self._recent.move_to_end(digests)
+                return True
+
+            return digests in self._current or \
+                (self._previous is not None and digests in self._previous)
+
+    def remember(self, message_ids):
+        with self._lock:
+            for message_id in message_ids:
+                digests = digest(message_id)
+
+                self._recent[digests] = None
+                self._recent.move_to_end(digests)
+                if len(self._recent) > self.recent_size:
+                    self._recent.popitem(last=False)
+
+                if self._current.count >= self.capacity:
+                    self._previous = self._current
+                    self._current = self._new_filter()
+
+                self._current.add(digests)
+
+    def filter(self, list_of_cmds):
+        """
+        Drop (id, msg, email) triplets already answered, or repeated within
+        the batch.  Nothing is remembered until remember() is called, so a
+        batch that fails part way is not treated as done.
+        """
+
+        fresh = list()
+        batch_ids = set()
+
+        for cmd in list_of_cmds:
+            if cmd[0] in batch_ids or cmd[0] in self:
+                self.duplicates += 1
+                continue
+
+            batch_ids.add(cmd[0])
+            fresh.append(cmd)
+
+        return fresh
+
+    @property
+    def memory_bytes(self):
+        # Roughly 100 bytes per OrderedDict entry for the recent digests
+        filters = self._current.memory_bytes * 2
+        return filters + len(self._recent) * 100
+
+    def stats(self):
+        return {
+            'duplicates': self.duplicates,
+            'bloom_bits': self._current.bits,
+            'bloom_hashes': self._current.hashes,
+            'memory_bytes': self.memory_bytes,
+        }
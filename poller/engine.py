@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+asyncio runtime for processing a poll batch concurrently
+
+The conductor calls are blocking (requests based), so the coroutines here
+push them onto a bounded thread pool.  A batch of N commands then takes
+roughly as long as the slowest command instead of the sum of all of them.
+Replies are sent by outbound.reply_queue, not from here.
+"""
+
+import asyncio
+import collections
+import functools
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+from pydantic import Json
+
+import parser
+import library
+import tracing
+import metrics
+from admission import SHED_REPLY
+
+
+class async_conductor_service:
+    """
+    Async counterpart to library.conductor_service
+
+    get/post/delete keep the same semantics (prefix the base URL, raise on
+    HTTP errors, return the decoded JSON), they just have to be awaited.
+    Use call() to run any library/parser function that takes the session
+    as its first argument, so the error-to-text mapping in functions like
+    library.create_reservation is shared rather than duplicated.
+    """
+
+    def __init__(self, session: library.conductor_service, concurrency=8):
+        self.session = session
+        self.concurrency = max(1, int(concurrency))
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.concurrency, thread_name_prefix='conductor'
+        )
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs)
+        )
+
+    async def get(self, url, **kwargs) -> Json:
+        return await self._run(self.session.get, url, **kwargs)
+
+    async def post(self, url, **kwargs) -> Json:
+        return await self._run(self.session.post, url, **kwargs)
+
+    async def delete(self, url, **kwargs) -> Json:
+        return await self._run(self.session.delete, url, **kwargs)
+
+    async def call(self, func, *args, **kwargs):
+        return await self._run(func, self.session, *args, **kwargs)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+async def parse_command_list(asvc: async_conductor_service, list_of_cmds):
+    """
+    Concurrent version of parser.parse_command_list
+
+    At most asvc.concurrency commands are in flight at once.  Commands
+    touching the same project (parser.command_key) run in their original
+    order.  Returns the list of (id, response) pairs in message order.
+    """
+
+    semaphore = asyncio.Semaphore(asvc.concurrency)
+    project_locks = collections.defaultdict(asyncio.Lock)
+
+    async def run_command(id, msg, email):
+        key = parser.command_key(msg)
+        if key is None:
+            async with semaphore:
+                result = await asvc.call(
+                    parser.parse_command, msg, email, message_id=id
+                )
+            return (id, result)
+
+        # Tasks start in message order and asyncio.Lock is FIFO, so taking
+        # the project lock first keeps same-project commands in order
+        async with project_locks[key]:
+            async with semaphore:
+                result = await asvc.call(
+                    parser.parse_command, msg, email, message_id=id
+                )
+        return (id, result)
+
+    responses = await asyncio.gather(
+        *(run_command(id, msg, email) for (id, msg, email) in list_of_cmds)
+    )
+
+    return list(responses)
+
+
+def dispatch(asvc, list_of_cmds):
+    """
+    Blocking entry point: parse and execute a whole batch, returning the
+    (id, response) pairs.  Sending the replies is left to the caller.
+    """
+
+    if not list_of_cmds:
+        return list()
+
+    return asyncio.run(parse_command_list(asvc, list_of_cmds))
+
+
+def next_batch(events, max_batch=25):
+    """Block for one event, then take whatever else is already queued"""
+    batch = [events.get()]
+
+    while len(batch) < max_batch:
+        try:
+            batch.append(events.get_nowait())
+        except queue.Empty:
+            break
+
+    return batch
+
+
+def batch_dispatcher(
+    conductor, concurrency=1, executor='asyncio', guard=None, admission=None,
+    fairness=None, planner=None
+):
+    """
+    Pick how the polling loops run a batch of (id, msg, email) triplets.
+
+    Returns a function taking the batch and returning (id, response) pairs:
+    the asyncio engine, the parser's thread pool, or plain serial parsing.
+    With a dedup.duplicate_guard, messages already answered are dropped
+    first and get no response.  Messages are remembered once their batch
+    completes.  With a fairness.fair_scheduler, commands over their user's
+    rate get the throttle reply and the rest run (and are answered) in fair
+    order.  With an admission.admission_queue, commands shed from an
+    oversized batch get the busy reply instead of being run.  Throttled and
+    shed commands are answered after the commands that ran.  With a
+    planner.query_planner, duplicate reads are run once.
+    """
+
+    if concurrency > 1 and executor == 'asyncio':
+        asvc = async_conductor_service(conductor, concurrency)
+        run = functools.partial(dispatch, asvc)
+    else:
+        run = functools.partial(
+            parser.parse_command_list, conductor, workers=concurrency
+        )
+
+    def traced(list_of_cmds):
+        if fairness:
+            list_of_cmds = fairness.order(list_of_cmds)
+
+        message_ids = [id for (id, msg, email) in list_of_cmds]
+        with tracing.span(
+            'dispatch', message_ids,
+            executor=executor, concurrency=concurrency
+        ):
+            if planner:
+                return planner.run(run, list_of_cmds)
+            return run(list_of_cmds)
+
+    def admitted(list_of_cmds):
+        if not admission:
+            return traced(list_of_cmds)
+
+        admit, shed = admission.admit(list_of_cmds)
+        if not shed:
+            return traced(admit)
+
+        print(f'Shedding {len(shed)} read-only command(s)')
+        metrics.commands_shed.inc(len(shed))
+
+        return traced(admit) + [(id, SHED_REPLY) for (id, msg, email) in shed]
+
+    def throttled(list_of_cmds):
+        if not fairness:
+            return admitted(list_of_cmds)
+
+        allowed, over = fairness.throttle(list_of_cmds)
+        if not over:
+            return admitted(allowed)
+
+        print(f'Throttling {len(over)} command(s)')
+        metrics.commands_throttled.inc(len(over))
+
+        return admitted(allowed) + [
+            (id, fairness.throttle_reply) for (id, msg, email) in over
+        ]
+
+    if not guard:
+        return throttled
+
+    def guarded(list_of_cmds):
+        response_message = throttled(guard.filter(list_of_cmds))
+        guard.remember([id for (id, response) in response_message])
+        return response_message
+
+    return guarded
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Fair scheduling of a command batch across users
+
+Commands are run, and their replies queued, in this order:
+- commands that change state (parser.mutating_commands) before read-only
+  ones
+- within each class, weighted fair queueing by personEmail: a user's n-th
+  command in the batch finishes at virtual time n / weight, so one user
+  pasting 25 commands is interleaved with everyone else instead of
+  delaying them
+
+Commands touching the same project keep their original relative order.
+Each user also has a token bucket; commands over it get a polite throttle
+reply instead of being run.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+import parser
+from ratelimit import token_bucket
+
+
+THROTTLE_REPLY = (
+    'You are sending commands faster than {rate:g} a minute, please wait a '
+    'moment and try again.'
+)
+
+
+def parse_weights(text):
+    """'ops@example.com=4;bot@example.com=0.5' -> {email: weight}"""
+    weights = dict()
+    for item in (text or '').split(';'):
+        if '=' in item:
+            email, weight = item.rsplit('=', 1)
+            weights[email.strip().lower()] = float(weight)
+    return weights
+
+
+class fair_scheduler:
+    def __init__(
+        self, weights=None, user_rate=0, user_burst=10, max_users=10000,
+        clock=time.monotonic
+    ):
+        self.weights = {
+            email.lower(): max(0.01, float(weight))
+            for email, weight in (weights or dict()).items()
+        }
+
+        # Commands per minute per user, 0 for no limit
+        self.user_rate = float(user_rate)
+        self.user_burst = user_burst
+        self.max_users = int(max_users)
+        self.clock = clock
+
+        self.throttled = 0
+        self.throttle_reply = THROTTLE_REPLY.format(rate=self.user_rate)
+
+        # email -> token_bucket, least recently seen first
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def weight(self, email):
+        return self.weights.get(str(email).lower(), 1.0)
+
+    def _bucket(self, email):
+        bucket = self._buckets.get(email)
+        if bucket is None:
+            bucket = self._buckets[email] = token_bucket(
+                self.user_rate / 60.0, self.user_burst, clock=self.clock
+            )
+            if len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(email)
+        return bucket
+
+    def throttle(self, list_of_cmds):
+        """Split the batch into (allowed, throttled), both in message order"""
+        if self.user_rate <= 0:
+            return list_of_cmds, list()
+
+        allowed = list()
+        throttled = list()
+
+        with self._lock:
+            for cmd in list_of_cmds:
+                if self._bucket(str(cmd[2]).lower()).try_acquire():
+                    allowed.append(cmd)
+                else:
+                    throttled.append(cmd)
+
+        self.throttled += len(throttled)
+        return allowed, throttled
+
+    def order(self, list_of_cmds):
+        """Priority, then fair share, then arrival order"""
+        seen = dict()
+        keys = list()
+
+        for idx, (id, msg, email) in enumerate(list_of_cmds):
+            email = str(email).lower()
+            seen[email] = seen.get(email, 0) + 1
+
+            priority = 1 if parser.is_read_only(msg) else 0
+            finish = seen[email] / self.weight(email)
+            keys.append((priority, finish, idx))
+
+        ordered = [list_of_cmds[idx] for (_, _, idx) in sorted(keys)]
+
+        # Same-project commands take the slots of their chain, in the order
+        # they were sent, so fairness never reorders a reserve and a cancel
+        chains = dict()
+        for cmd in list_of_cmds:
+            key = parser.command_key(cmd[1])
+            if key is not None:
+                chains.setdefault(key, list()).append(cmd)
+
+        for key, chain in chains.items():
+            if len(chain) < 2:
+                continue
+            slots = [
+                pos for pos, cmd in enumerate(ordered)
+                if parser.command_key(cmd[1]) == key
+            ]
+            for pos, cmd in zip(slots, chain):
+                ordered[pos] = cmd
+
+        return ordered
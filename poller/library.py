@@ -6,45 +6,289 @@ TODO:  Convert service to python module to remove code deduplication
 
 
 import json
+import math
+import random
+import time
+from urllib.parse import urlencode
 
 import requests
 from pydantic import Json
-
-from service.models import ProjectInput
-from service.models import ScenarioInput
+from requests.adapters import HTTPAdapter
+
+import codec
+import metrics
+import tracing
+from breaker import breaker_group
+from cache import ttl_cache, validator_store, MISSING
+from service.models import trusted
+from service.models import Project, ProjectCore, ProjectInput
+from service.models import Scenario, ScenarioCore, ScenarioInput
+from service.models import Reservation, ReservationCore
 from service.models import ReservationInput, ReservationEmail
 
 
+# Only these are retried: a POST or DELETE may have been applied even
+# though its response was lost (a second cancel would report 404)
+idempotent_methods = {'GET', 'HEAD', 'OPTIONS'}
+
+# Worth another attempt: overloaded or restarting conductor, bad gateway
+retry_statuses = {429, 502, 503, 504}
+
+
+def backoff_delay(attempt, backoff=0.25, max_backoff=4.0):
+    """Full jitter: uniform in [0, backoff * 2^attempt], capped"""
+    return random.uniform(0, min(max_backoff, backoff * (2 ** attempt)))
+
+
+def encode(kwargs):
+    """Send a json= body compactly, through the codec"""
+    if kwargs.get('json') is not None:
+        kwargs = dict(kwargs)
+        kwargs['data'] = codec.dumps(kwargs.pop('json'))
+    return kwargs
+
+
+def failed_response(url, status, detail):
+    """
+    Stand-in response for a conductor that never answered, so callers see
+    an HTTPError with a status and detail like any other failure
+    """
+    response = requests.Response()
+    response.status_code = status
+    response.reason = 'Service Unavailable' if status == 503 \
+        else 'Gateway Timeout'
+    response.url = url
+    response.headers['Content-Type'] = 'application/json'
+    response._content = json.dumps({'detail': detail}).encode()
+    return response
+
+
 class conductor_service(requests.Session):
-    def __init__(self, proto='http', host='localhost', port=8000):
+    def __init__(
+        self, proto='http', host='localhost', port=8000,
+        cache_size=256, cache_ttls=None,
+        connect_timeout=3.05, read_timeout=10.0, pool_size=16,
+        retries=3, backoff=0.25, max_backoff=4.0, deadline=20.0,
+        breaker_failures=5, breaker_reset=30.0, validator_size=1024
+    ):
         requests.Session.__init__(self)
 
         self.__url = f'{proto}://{host}:{port}'
         self._version = None
 
+        # Read-through cache for GETs, cleared per endpoint group on writes
+        self.cache = ttl_cache(ttls=cache_ttls, max_entries=cache_size)
+
+        # Bodies kept for conditional GETs (If-None-Match/If-Modified-Since)
+        self.validators = validator_store(max_entries=validator_size)
+
+        # reservations.reservation_index answering reservation lookups
+        self.reservations = None
+
+        # Keep-alive connections for every concurrent command
+        adapter = HTTPAdapter(pool_maxsize=int(pool_size), max_retries=0)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+        self.connect_timeout = float(connect_timeout)
+        self.read_timeout = float(read_timeout)
+        self.retries = int(retries)
+        self.backoff = float(backoff)
+        self.max_backoff = float(max_backoff)
+
+        # Total seconds a single call may take, retries included
+        self.deadline = float(deadline)
+
+        # Fail fast on an endpoint group that keeps failing
+        self.breakers = breaker_group(
+            ['/project/', '/scenario/', '/reserve/project/'],
+            failures=breaker_failures, reset_timeout=breaker_reset
+        )
+
         self.headers.update(
             {'Content-Type': 'application/json; charset=utf-8'}
         )
 
     # Some light overloading to make the api calls here reflect
     # the API documentation (/logon)
-    def get(self, url, **kwargs) -> Json:
-        url = self.__url + url
-        response = requests.Session.get(self, url, **kwargs)
-        response.raise_for_status()
-        return response.json()
-
-    def post(self, url, **kwargs) -> Json:
-        url = self.__url + url
-        response = requests.Session.post(self, url, **kwargs)
+    def get(self, url, deadline=None, cached=True, **kwargs) -> Json:
+        # Only plain lookups (optionally with query params) are cached
+        cache_key = None
+        if cached and set(kwargs) <= {'params'}:
+            params = kwargs.get('params')
+            cache_key = f'{url}?{urlencode(sorted(params.items()))}' \
+                if params else url
+
+            payload = self.cache.get(cache_key)
+            if payload is not MISSING:
+                return payload
+
+            kwargs['headers'] = self.validators.headers(cache_key)
+
+        response = self._request('GET', url, deadline, **kwargs)
+
+        payload = MISSING
+        if response.status_code == 304 and cache_key:
+            # Unchanged: no body was sent, and none needs decoding
+            payload = self.validators.get(cache_key)
+            if payload is MISSING:
+                kwargs['headers'] = dict()
+                response = self._request('GET', url, deadline, **kwargs)
+
+        if payload is MISSING:
+            response.raise_for_status()
+            payload = codec.loads(response.content)
+            if cache_key:
+                self.validators.put(cache_key, response, payload)
+
+        if cache_key:
+            self.cache.put(cache_key, payload)
+
+        return payload
+
+    def _endpoint(self, url):
+        # Endpoint group for metrics (not the URL, which includes names)
+        return self.cache.group(url) or '/' + url.strip('/').split('/')[0]
+
+    def _request(self, method, url, deadline=None, **kwargs):
+        endpoint = self._endpoint(url)
+
+        # Fail fast, without touching the conductor, while the circuit is open
+        prefix, breaker = self.breakers.for_url(url)
+        if breaker and not breaker.allow():
+            metrics.conductor_rejected.inc(endpoint=prefix)
+            return failed_response(
+                self.__url + url, 503,
+                f'Conductor {prefix} requests are failing, not retrying '
+                f'for {math.ceil(breaker.retry_in())}s'
+            )
+
+        status = 'error'
+        start = time.perf_counter()
+
+        try:
+            with tracing.span(
+                'conductor', method=method, endpoint=endpoint
+            ) as span:
+                response, attempts = self._send_with_retries(
+                    method, url, self.deadline if deadline is None
+                    else float(deadline), **kwargs
+                )
+                status = response.status_code
+                span.set(status=status, attempts=attempts)
+            return response
+
+        finally:
+            metrics.conductor_seconds.observe(
+                time.perf_counter() - start,
+                method=method, endpoint=endpoint, status=status
+            )
+
+            # Client errors (404, 409...) mean the conductor is answering
+            if breaker:
+                breaker.record(status != 'error' and status < 500 and
+                               status != 429)
+
+    def _send_with_retries(self, method, url, deadline, **kwargs):
+        """
+        Returns (response, attempts).  Each attempt gets the connect/read
+        timeouts, cut short by what is left of the deadline.  A conductor
+        that cannot be reached in time, or whose response breaks off, yields
+        a 503/504 stand-in response.
+        """
+
+        expires = time.monotonic() + deadline
+        attempts = self.retries + 1 if method in idempotent_methods else 1
+
+        for attempt in range(1, attempts + 1):
+            remaining = expires - time.monotonic()
+            timeout = (
+                min(self.connect_timeout, remaining),
+                min(self.read_timeout, remaining)
+            )
+
+            try:
+                response = requests.Session.request(
+                    self, method, self.__url + url, timeout=timeout, **kwargs
+                )
+                if response.status_code not in retry_statuses:
+                    return response, attempt
+                reason = response.status_code
+
+            except requests.Timeout:
+                response = failed_response(
+                    self.__url + url, 504, 'Conductor did not respond in time'
+                )
+                reason = 'timeout'
+
+            except requests.ConnectionError:
+                response = failed_response(
+                    self.__url + url, 503, 'Conductor service unreachable'
+                )
+                reason = 'connection'
+
+            # e.g. ChunkedEncodingError, ContentDecodingError mid-body
+            except requests.RequestException as err:
+                response = failed_response(
+                    self.__url + url, 503,
+                    f'Conductor response failed ({type(err).__name__})'
+                )
+                reason = 'error'
+
+            if attempt == attempts:
+                break
+
+            pause = backoff_delay(attempt - 1, self.backoff, self.max_backoff)
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                pause = max(pause, float(retry_after))
+
+            # No point waiting for an attempt that cannot finish in time
+            if time.monotonic() + pause >= expires:
+                break
+
+            metrics.conductor_retries.inc(
+                method=method, endpoint=self._endpoint(url), reason=reason
+            )
+            time.sleep(pause)
+
+        return response, attempt
+
+    def get_pages(self, url, page_size=100):
+        """
+        Yield the pages of a list endpoint (?skip=N&limit=M), one request
+        per page, stopping at the first short page.  A conductor without
+        paging returns everything at once, which is treated as the last page.
+        """
+
+        skip = 0
+        previous = None
+        while True:
+            page = self.get(url, params={'skip': skip, 'limit': page_size})
+
+            # Same page again means the conductor ignored skip/limit
+            if previous and page and page[0] == previous[0]:
+                return
+
+            yield page
+
+            if len(page) != page_size:
+                return
+
+            previous = page
+            skip += page_size
+
+    def post(self, url, deadline=None, **kwargs) -> Json:
+        response = self._request('POST', url, deadline, **encode(kwargs))
         response.raise_for_status()
-        return response.json()
+        self.cache.invalidate(url)
+        return codec.loads(response.content)
 
-    def delete(self, url, **kwargs) -> Json:
-        url = self.__url + url
-        response = requests.Session.delete(self, url, **kwargs)
+    def delete(self, url, deadline=None, **kwargs) -> Json:
+        response = self._request('DELETE', url, deadline, **encode(kwargs))
         response.raise_for_status()
-        return response.json()
+        self.cache.invalidate(url)
+        return codec.loads(response.content)
 
     @property
     def version(self):
@@ -62,12 +306,83 @@ class conductor_service(requests.Session):
         self._version = str(payload['version'])
 
 
+# Webex rejects messages over 7439 bytes, leave room for the threading
+MESSAGE_LIMIT = 7000
+
+
+def render_chunks(lines, limit=MESSAGE_LIMIT):
+    """
+    Join lines into messages of at most `limit` bytes, yielding each one as
+    soon as it is full so only a single chunk is ever held in memory.
+    """
+
+    chunk = list()
+    size = 0
+
+    for line in lines:
+        length = len(line.encode()) + 1
+        if chunk and size + length > limit:
+            yield '\n'.join(chunk)
+            chunk = list()
+            size = 0
+
+        chunk.append(line)
+        size += length
+
+    if chunk:
+        yield '\n'.join(chunk)
+
+
+def render_list(session, url, header, format_item, page_size=100,
+                lookahead=10):
+    """
+    Fetch a list endpoint page by page and render it in message-sized
+    chunks.  Up to `lookahead` pages are fetched right away, while the
+    command runs (so an empty list or a conductor error shows up
+    immediately, and reply senders do not wait on the conductor).  Only
+    longer lists fetch the rest lazily as the chunks are sent, and a page
+    that fails then ends the list with an error line.  Returns None when
+    the list is empty.
+    """
+
+    pages = session.get_pages(url, page_size)
+    fetched = [next(pages)]
+
+    if len(fetched[0]) == 0:
+        return None
+
+    # A short page was the last one, get_pages is then exhausted
+    while len(fetched) < lookahead and len(fetched[-1]) == page_size:
+        page = next(pages, None)
+        if page is None:
+            break
+        fetched.append(page)
+
+    def lines():
+        yield header
+        for page in fetched:
+            for item in page:
+                yield format_item(item)
+
+        try:
+            for page in pages:
+                for item in page:
+                    yield format_item(item)
+        except requests.HTTPError as err:
+            status_code = err.response.status_code
+            reason = json.loads(err.response.text)['detail']
+            yield f'Failed to get the rest of the list ({status_code}): {reason}'
+
+    return render_chunks(lines())
+
+
 def extract_project_details(payload):
+    project = trusted(Project, payload)
     output = list()
 
-    output.append(f'Name: {payload["name"]}')
-    output.append(f'Title: {payload["title"]}')
-    output.append(f'Description: {payload["description"]}')
+    output.append(f'Name: {project.name}')
+    output.append(f'Title: {project.title}')
+    output.append(f'Description: {project.description}')
 
     return '\n'.join(output)
 
@@ -104,21 +419,28 @@ def create_project(
         # return '\n'.join(error_message)
 
 
-def get_list_of_projects(session: conductor_service):
-    # URL returns JSON list of ProjectCore
-    payload: Json = session.get('/project/')
+def format_project(item):
+    project = trusted(ProjectCore, item)
+    return f'{project.name} - {project.title}'
 
-    if len(payload) == 0:
-        return 'No projects found.'
 
-    output = [
-        'Project name - Project Title'
-    ]
+def get_list_of_projects(session: conductor_service):
+    # URL returns JSON list of ProjectCore, rendered as message chunks
+    try:
+        chunks = render_list(
+            session, '/project/', 'Project name - Project Title',
+            format_project
+        )
+    except requests.HTTPError as err:
+        status_code = err.response.status_code
+        reason = json.loads(err.response.text)['detail']
+
+        return f'Failed to get list of projects ({status_code}): {reason}'
 
-    for project in payload:
-        output.append(f'{project["name"]} - {project["title"]}')
+    if chunks is None:
+        return 'No projects found.'
 
-    return '\n'.join(output)
+    return chunks
 
 
 def get_project_details(session: conductor_service, name: str):
@@ -135,12 +457,13 @@ def get_project_details(session: conductor_service, name: str):
 
 
 def extract_scenario_details(payload):
+    scenario = trusted(Scenario, payload)
     output = list()
 
-    output.append(f'Name: {payload["name"]}')
-    output.append(f'Project: {payload["project"]}')
-    output.append(f'Title: {payload["title"]}')
-    output.append(f'Description: {payload["description"]}')
+    output.append(f'Name: {scenario.name}')
+    output.append(f'Project: {scenario.project}')
+    output.append(f'Title: {scenario.title}')
+    output.append(f'Description: {scenario.description}')
 
     return '\n'.join(output)
 
@@ -170,23 +493,28 @@ def create_scenario(
         return f'Failed to create scenario ({status_code}): {reason}'
 
 
-def get_list_of_scenarios(session: conductor_service):
-    # URL returns JSON list of ScenarioCore
-    payload: Json = session.get('/scenario/')
-
-    if len(payload) == 0:
-        return 'No scenarios found.'
+def format_scenario(item):
+    scenario = trusted(ScenarioCore, item)
+    return f'{scenario.project}/{scenario.name} - {scenario.title}'
 
-    output = [
-        'Project/Scenario name - Scenario Title'
-    ]
 
-    for scenario in payload:
-        output.append(
-            f'{scenario["project"]}/{scenario["name"]} - {scenario["title"]}'
+def get_list_of_scenarios(session: conductor_service):
+    # URL returns JSON list of ScenarioCore, rendered as message chunks
+    try:
+        chunks = render_list(
+            session, '/scenario/', 'Project/Scenario name - Scenario Title',
+            format_scenario
         )
+    except requests.HTTPError as err:
+        status_code = err.response.status_code
+        reason = json.loads(err.response.text)['detail']
 
-    return '\n'.join(output)
+        return f'Failed to get list of scenarios ({status_code}): {reason}'
+
+    if chunks is None:
+        return 'No scenarios found.'
+
+    return chunks
 
 
 def get_scenario_details(session: conductor_service, name: str):
@@ -203,14 +531,15 @@ def get_scenario_details(session: conductor_service, name: str):
 
 
 def extract_reservation_details(payload):
+    reservation = trusted(Reservation, payload)
     output = list()
 
-    hours = float(payload["ttl"])/3600.0
+    hours = float(reservation.ttl)/3600.0
 
-    output.append(f'Project: {payload["project"]}')
-    output.append(f'Lease ID: {payload["id"]}')
+    output.append(f'Project: {reservation.project}')
+    output.append(f'Lease ID: {reservation.id}')
     output.append(f'Time Remaining (hrs): {hours}')
-    output.append(f'Owner: {payload["email"]}')
+    output.append(f'Owner: {reservation.email}')
 
     return '\n'.join(output)
 
@@ -226,6 +555,8 @@ def create_reservation(
         response = session.post('/reserve/project/', json=body.dict())
 
         # Response (if successful) is a Reservation object
+        if session.reservations:
+            session.reservations.update(response)
         results = extract_reservation_details(response)
         return f'Reservation successful:\n\n{results}'
 
@@ -246,6 +577,8 @@ def cancel_reservation(session: conductor_service, project: str, email: str):
         session.delete(
             f'/reserve/project/{project}', json=body.dict()
         )
+        if session.reservations:
+            session.reservations.remove(project)
         return f'Reservation for project {project} deleted.'
 
     except requests.RequestException as err:
@@ -262,6 +595,13 @@ def cancel_reservation(session: conductor_service, project: str, email: str):
 
 
 def get_reservation_details(session: conductor_service, project: str):
+    # Time remaining computed locally, if the index knows the reservation
+    index = session.reservations
+    if index and index.ready():
+        payload = index.get(project)
+        if payload is not None:
+            return extract_reservation_details(payload)
+
     try:
         # Payload is a Reservation object
         payload: Json = session.get(f'/reserve/project/{project}')
@@ -274,20 +614,35 @@ def get_reservation_details(session: conductor_service, project: str):
         return f'Failed to get reservation details ({status_code}): {reason}'
 
 
-def get_list_of_reservations(session: conductor_service):
-    # JSON list of ReservationCore
-    payload: Json = session.get('/reserve/project/')
+def format_reservation(item):
+    reservation = trusted(ReservationCore, item)
+    return f'{reservation.project} - {reservation.email}'
 
-    if len(payload) == 0:
-        return "No reservations found."
 
-    output = [
-        "Project - Owner"
-    ]
+def get_list_of_reservations(session: conductor_service):
+    index = session.reservations
+    if index and index.ready():
+        items = index.all()
+        if not items:
+            return "No reservations found."
+
+        lines = ['Project - Owner']
+        lines.extend(format_reservation(item) for item in items)
+        return render_chunks(lines)
 
-    for reservation in payload:
-        output.append(
-            f'{reservation["project"]} - {reservation["email"]}'
+    # JSON list of ReservationCore, rendered as message chunks
+    try:
+        chunks = render_list(
+            session, '/reserve/project/', 'Project - Owner',
+            format_reservation
         )
+    except requests.HTTPError as err:
+        status_code = err.response.status_code
+        reason = json.loads(err.response.text)['detail']
+
+        return f'Failed to get list of reservations ({status_code}): {reason}'
+
+    if chunks is None:
+        return "No reservations found."
 
-    return "\n".join(output)
+    return chunks
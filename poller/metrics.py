@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Metrics in the Prometheus text format
+
+A small in-process registry of counters, histograms and callback gauges,
+served on a local HTTP port (METRICS_PORT) for Prometheus to scrape.  The
+metrics used across the service are defined at the bottom of this module.
+"""
+
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Seconds, from a cached conductor lookup up to a slow Webex call
+default_buckets = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0
+)
+
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+
+    escaped = (
+        (name, str(value).replace('\\', r'\\').replace('"', r'\"')
+         .replace('\n', r'\n'))
+        for (name, value) in pairs
+    )
+    return '{' + ','.join(f'{name}="{value}"' for (name, value) in escaped) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+        self._values = dict()
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name}_total {self.help}',
+            f'# TYPE {self.name}_total counter',
+        ]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                labels = format_labels(self.labels, key)
+                lines.append(f'{self.name}_total{labels} {format_value(value)}')
+        return lines
+
+
+class histogram:
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+
+        # label values -> [bucket counts..., sum, count]
+        self._values = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        idx = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [0] * (len(self.buckets) + 2)
+
+            if idx < len(self.buckets):
+                series[idx] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def count(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            series = self._values.get(key)
+            return series[-1] if series else 0
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} histogram',
+        ]
+        with self._lock:
+            for key, series in sorted(self._values.items()):
+                # Buckets are cumulative in the exposition format
+                cumulative = 0
+                for bound, hits in zip(self.buckets, series):
+                    cumulative += hits
+                    labels = format_labels(
+                        self.labels, key, ('le', format_value(bound))
+                    )
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+
+                labels = format_labels(self.labels, key, ('le', '+Inf'))
+                lines.append(f'{self.name}_bucket{labels} {series[-1]}')
+
+                labels = format_labels(self.labels, key)
+                lines.append(
+                    f'{self.name}_sum{labels} {format_value(series[-2])}'
+                )
+                lines.append(f'{self.name}_count{labels} {series[-1]}')
+        return lines
+
+
+class gauge:
+    """
+    Value read from a callback at scrape time (e.g. a queue depth).  With
+    labels, the callback returns {label values tuple: value}.
+    """
+
+    def __init__(self, name, help, func, labels=()):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.labels = tuple(labels)
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} gauge',
+        ]
+        if not self.labels:
+            lines.append(f'{self.name} {format_value(self.func())}')
+            return lines
+
+        for key, value in sorted(self.func().items()):
+            labels = format_labels(self.labels, key)
+            lines.append(f'{self.name}{labels} {format_value(value)}')
+        return lines
+
+
+class metrics_registry:
+    def __init__(self):
+        self._metrics = dict()
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=default_buckets):
+        return self.register(histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, func, labels=()):
+        return self.register(gauge(name, help, func, labels))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = list()
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class metrics_handler(BaseHTTPRequestHandler):
+    # Set on the server instance: registry
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host='127.0.0.1', port=9100, registry=None):
+    """Serve /metrics from a background thread, returns the server"""
+    server = ThreadingHTTPServer((host, int(port)), metrics_handler)
+    server.daemon_threads = True
+    server.registry = registry or default_registry
+
+    threading.Thread(
+        target=server.serve_forever, name='metrics', daemon=True
+    ).start()
+
+    return server
+
+
+default_registry = metrics_registry()
+
+poll_seconds = default_registry.histogram(
+    'poller_poll_seconds', 'Time to fetch new messages in one poll',
+    labels=('source',)
+)
+poll_messages = default_registry.histogram(
+    'poller_poll_messages', 'New commands returned by one poll',
+    labels=('source',), buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250)
+)
+command_seconds = default_registry.histogram(
+    'poller_command_seconds', 'Time to run one chat command',
+    labels=('command',)
+)
+command_errors = default_registry.counter(
+    'poller_command_errors', 'Chat commands that raised', labels=('command',)
+)
+conductor_seconds = default_registry.histogram(
+    'poller_conductor_seconds', 'Conductor request latency (cache misses)',
+    labels=('method', 'endpoint', 'status')
+)
+conductor_retries = default_registry.counter(
+    'poller_conductor_retries', 'Conductor requests retried',
+    labels=('method', 'endpoint', 'reason')
+)
+conductor_rejected = default_registry.counter(
+    'poller_conductor_rejected', 'Conductor calls failed fast (circuit open)',
+    labels=('endpoint',)
+)
+commands_shed = default_registry.counter(
+    'poller_commands_shed', 'Read-only commands shed by admission control'
+)
+commands_throttled = default_registry.counter(
+    'poller_commands_throttled', 'Commands over their user\'s rate limit'
+)
+commands_deduped = default_registry.counter(
+    'poller_commands_deduped', 'Duplicate read commands answered from one run'
+)
+webex_send_seconds = default_registry.histogram(
+    'poller_webex_send_seconds', 'Webex messages.create latency'
+)
+rate_limits = default_registry.counter(
+    'poller_rate_limits', 'Webex rate limit responses',
+    labels=('source',)
+)
+loop_lag_seconds = default_registry.histogram(
+    'poller_loop_lag_seconds', 'Poll start behind its scheduled time',
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 15.0, 60.0)
+)
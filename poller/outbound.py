@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Outbound reply pipeline for Webex messages
+
+Replies are queued by the ingest loop and sent by a small pool of worker
+threads, so replying to a large batch no longer delays the next poll.
+Sends go through a token bucket sized for the Webex message create limit.
+The Webex client is built with wait_on_rate_limit=False, so a 429 raises
+RateLimitError here and pauses the bucket shared by every sender (for
+retry_after seconds), not the whole process.
+"""
+
+import queue
+import threading
+import time
+
+from webexteamssdk.exceptions import RateLimitError
+
+import metrics
+import tracing
+from ratelimit import token_bucket
+
+
+def reply_chunks(response):
+    """
+    A response is either a string or an iterable of message-sized chunks
+    (see library.render_chunks), sent as separate threaded replies.
+    """
+    return [response] if isinstance(response, str) else response
+
+
+def describe(response):
+    """Response for the logs: the text, never a chunk generator"""
+    return response if isinstance(response, str) else '<chunked reply>'
+
+
+def error_chunk(chunks):
+    """
+    Pass chunks through, ending with an error message instead of stopping
+    silently if generating the rest of the reply fails
+    """
+    try:
+        yield from chunks
+    except Exception as err:
+        print(f'Failed to generate the rest of a reply: {err!r}')
+        yield 'Sorry, the rest of this reply could not be retrieved.'
+
+
+class reply_queue:
+    def __init__(
+        self, webex, workers=4, rate=5.0, burst=10, max_attempts=5,
+        limiter=None, on_sent=None, on_failed=None
+    ):
+        self.webex = webex
+        self.on_sent = on_sent
+        self.on_failed = on_failed
+        self.workers = max(1, int(workers))
+        self.max_attempts = max(1, int(max_attempts))
+        self.limiter = limiter or token_bucket(rate, burst)
+
+        self.sent = 0
+        self.failed = 0
+        self.rate_limited = 0
+
+        self._queue = queue.Queue()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._threads = list()
+
+    def start(self):
+        for idx in range(self.workers):
+            thread = threading.Thread(
+                target=self._worker, name=f'reply-{idx}', daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+        return self
+
+    def stop(self, wait=True):
+        for _ in self._threads:
+            self._queue.put(None)
+
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+        self._threads = list()
+
+    def put(self, room_id, text, parent_id=None, markdown=False):
+        """markdown=True sends the text as markdown (e.g. for mentions)"""
+        self._queue.put((room_id, parent_id, text, time.time(), markdown))
+
+    def put_responses(self, room_id, msg_list):
+        """Queue a list of (parent_id, text) pairs from parse_command_list"""
+        for (parent_id, msg) in msg_list:
+            self.put(room_id, msg, parent_id=parent_id)
+
+    def join(self):
+        """Block until everything queued so far has been sent (or failed)"""
+        self._queue.join()
+
+    @property
+    def depth(self):
+        """Replies waiting to be sent, including the ones being sent"""
+        with self._lock:
+            return self._queue.qsize() + self._in_flight
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'sent': self.sent,
+            'failed': self.failed,
+            'rate_limited': self.rate_limited,
+        }
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+
+            if item is None:
+                self._queue.task_done()
+                return
+
+            with self._lock:
+                self._in_flight += 1
+
+            try:
+                self._send(*item)
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+                self._queue.task_done()
+
+    def _send(self, room_id, parent_id, response, queued, markdown=False):
+        if parent_id:
+            tracing.record('reply_wait', parent_id, queued, time.time())
+
+        try:
+            # Chunked responses are generated lazily, one chunk at a time
+            with tracing.message(parent_id), tracing.span('reply') as span:
+                chunks = 0
+                for text in error_chunk(reply_chunks(response)):
+                    if not self._send_text(
+                        room_id, parent_id, text, markdown
+                    ):
+                        raise Exception('message create failed')
+                    chunks += 1
+                span.set(chunks=chunks)
+
+            if not isinstance(response, str):
+                print(f'Sent {chunks} chunk(s) in reply to {parent_id}')
+
+        except Exception as err:
+            print(f'Failed to send reply to {parent_id}: {err}')
+            with self._lock:
+                self.failed += 1
+            if parent_id:
+                tracing.finish(parent_id, failed=True)
+
+            # e.g. stop the checkpoint journal from re-sending it forever
+            if self.on_failed and parent_id:
+                self.on_failed(room_id, parent_id)
+            return
+
+        with self._lock:
+            self.sent += 1
+
+        if parent_id:
+            tracing.finish(parent_id)
+
+        # e.g. mark the message as replied in the checkpoint journal
+        if self.on_sent and parent_id:
+            self.on_sent(room_id, parent_id)
+
+    def _send_text(self, room_id, parent_id, text, markdown=False):
+        kwargs = {'roomId': room_id, 'markdown' if markdown else 'text': text}
+        if parent_id:
+            kwargs['parentId'] = parent_id
+
+        for attempt in range(1, self.max_attempts + 1):
+            self.limiter.acquire()
+
+            start = time.perf_counter()
+            try:
+                self.webex.messages.create(**kwargs)
+                return True
+
+            except RateLimitError as rle:
+                with self._lock:
+                    self.rate_limited += 1
+                metrics.rate_limits.inc(source='reply')
+                print(f'Rate Limit Error on reply: {rle.retry_after}')
+                self.limiter.pause(rle.retry_after)
+
+            finally:
+                metrics.webex_send_seconds.observe(
+                    time.perf_counter() - start
+                )
+
+        return False
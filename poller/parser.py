@@ -2,8 +2,14 @@
 
 
 import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pydantic import ValidationError
 
 import library
+import metrics
+import tracing
 
 
 # TODO: Convert this hack to click or typer
@@ -103,7 +109,8 @@ def reserve_project(svc, args, email=None, **kwargs):
 
     # Some crude error checking here
     if (len(args) != 4) or (args[1] != 'for') or \
-       (not int(args[2])) or (args[3] not in ['hours', 'days']):
+       (not args[2].isdigit()) or (not int(args[2])) or \
+       (args[3] not in ['hours', 'days']):
         return "\n".join(message)
 
     # Convert time to a timedelta
@@ -171,6 +178,16 @@ supported_commands = {
 }
 
 
+# Commands that change conductor state.  These are serialized per project
+# when a batch is run in parallel, everything else runs freely.
+mutating_commands = {
+    ('project', 'create'),
+    ('scenario', 'create'),
+    ('reserve', 'project'),
+    ('reserve', 'cancel'),
+}
+
+
 def help():
     lines = []
     lines.append('Supported commands are:')
@@ -184,7 +201,117 @@ def help():
     return '\n'.join(lines)
 
 
-def parse_command_list(svc, list_of_cmds):
+def command_name(msg):
+    """'resource action' for a supported command, else 'help' or 'unknown'"""
+    words = msg[3:].split()
+
+    if len(words) == 0 or words[0] == 'help':
+        return 'help'
+
+    if len(words) > 1 and words[1] in supported_commands.get(words[0], ()):
+        return f'{words[0]} {words[1]}'
+
+    return 'unknown'
+
+
+COMMAND_ERROR = 'Sorry, that command failed.  Try "help" for the usage.'
+
+
+def parse_command(svc, msg, email, message_id=None):
+    """
+    Parse and execute a single chat command
+
+    - msg is the text of the message (bot name included)
+    - email is the personEmail attribute of the message
+    - message_id, if given, is the trace the conductor calls belong to
+
+    Returns the response to the command: the validation messages if its
+    input was rejected, COMMAND_ERROR if it raised anything else
+    """
+
+    name = command_name(msg)
+    start = time.perf_counter()
+    try:
+        with tracing.message(message_id), tracing.span('command', command=name):
+            return run_command(svc, msg, email)
+
+    # Tell the user what to fix, e.g. "name must be valid URL path"
+    except ValidationError as err:
+        details = '\n'.join(
+            f'\t{".".join(map(str, error["loc"]))}: {error["msg"]}'
+            for error in err.errors()
+        )
+        return f'Invalid input:\n{details}'
+
+    # One bad command must not take the batch (and its cursor) down with it
+    except Exception as err:
+        print(f'Command {msg[3:]!r} failed: {err!r}')
+        metrics.command_errors.inc(command=name)
+        return COMMAND_ERROR
+
+    finally:
+        metrics.command_seconds.observe(
+            time.perf_counter() - start, command=name
+        )
+
+
+def run_command(svc, msg, email):
+    # Strip the bot name out of the message
+    words = msg[3:].split()
+
+    # Special case: help
+    if len(words) == 0 or words[0] == 'help':
+        return help()
+
+    # Pattern:  resource action arguments
+    if words[0] not in supported_commands:
+        result = f'Resource {words[0]} not recognized from: '
+        result += str(msg[3:])
+        return result
+
+    # Maybe later, standardize this to add 'help' and pass along?
+    if len(words) == 1:
+        return f'No command provided for resource {words[0]}'
+
+    # Okay, valid function now
+    if words[1] not in supported_commands[words[0]]:
+        return f'Command {words[1]} not recognized for resource {words[0]}'
+
+    # Call the function pointed to by the dictionary
+    command_parse = supported_commands[words[0]][words[1]]
+
+    if len(words) > 2:
+        return command_parse(svc, words[2:], email=email)
+
+    return command_parse(svc, email=email)
+
+
+def is_read_only(msg):
+    """True unless the message is one of the mutating_commands"""
+    words = msg[3:].split()
+    return len(words) < 2 or (words[0], words[1]) not in mutating_commands
+
+
+def command_key(msg):
+    """
+    Return the project name a mutating command touches, None otherwise.
+
+    project create X, reserve project X, reserve cancel X -> X
+    scenario create name X -> X (the scenario's project)
+    """
+
+    words = msg[3:].split()
+
+    if len(words) < 3 or (words[0], words[1]) not in mutating_commands:
+        return None
+
+    if words[0] == 'scenario':
+        return words[3] if len(words) > 3 else None
+
+    return words[2]
+
+
+def parse_command_list(svc, list_of_cmds, workers=1):
     """
     Expecting a list of (id, command, email) triplets where:
     - id is the message ID
@@ -195,56 +322,50 @@ def parse_command_list(svc, list_of_cmds):
     make the correct maestro library call for each command, return a list
     of all responses for each message
 
+    With workers > 1 the commands run on a thread pool.  Commands touching
+    the same project (see command_key) still run in their original order,
+    read-only commands run freely.
+
     Returns list of (id, response) pairs:
     - message ID
     - string response to the command
     """
 
+    if workers > 1 and len(list_of_cmds) > 1:
+        return parse_command_list_parallel(svc, list_of_cmds, workers)
+
     return_responses = list()
 
     # Loop over all the messages
     for (id, msg, email) in list_of_cmds:
+        result = parse_command(svc, msg, email, message_id=id)
+        return_responses.append((id, result))
 
-        # Strip the bot name out of the message
-        words = msg[3:].split()
-
-        # Special case: help
-        if len(words) == 0 or words[0] == 'help':
-            result = help()
-
-            return_responses.append((id, result))
-            continue
-
-        # Pattern:  resource action arguments
-        if words[0] not in supported_commands:
-            result = f'Resource {words[0]} not recognized from: '
-            result += str(msg[3:])
-
-            return_responses.append((id, result))
-            continue
-
-        # Maybe later, standardize this to add 'help' and pass along?
-        if len(words) == 1:
-            result = f'No command provided for resource {words[0]}'
+    return return_responses
 
-            return_responses.append((id, result))
-            continue
 
-        # Okay, valid function now
-        if words[1] not in supported_commands[words[0]]:
-            result = f'Command {words[1]} not recognized for resource {words[0]}'
+def parse_command_list_parallel(svc, list_of_cmds, workers):
+    # Group the batch into chains: one per project key, one per free command
+    chains = dict()
+    for idx, (id, msg, email) in enumerate(list_of_cmds):
+        key = command_key(msg)
+        chain = ('project', key) if key is not None else ('free', idx)
+        chains.setdefault(chain, list()).append(idx)
 
-            return_responses.append((id, result))
-            continue
+    results = [None] * len(list_of_cmds)
 
-        # Call the function pointed to by the dictionary
-        command_parse = supported_commands[words[0]][words[1]]
+    def run_chain(indexes):
+        for idx in indexes:
+            (id, msg, email) = list_of_cmds[idx]
+            results[idx] = (
+                id, parse_command(svc, msg, email, message_id=id)
+            )
 
-        if len(words) > 2:
-            result = command_parse(svc, words[2:], email=email)
-        else:
-            result = command_parse(svc, email=email)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_chain, idxs) for idxs in chains.values()]
 
-        return_responses.append((id, result))
+        # Surface the first exception (e.g. rate limiting) to the caller
+        for future in futures:
+            future.result()
 
-    return return_responses
+    return results
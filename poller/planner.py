@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Query planning for a command batch
+
+Looks at the whole batch before it is run: identical read-only commands
+(same words, no state change in between) are run once and every message
+gets the same answer.
+"""
+
+import threading
+
+import metrics
+import parser
+
+
+class query_planner:
+    def __init__(self):
+        self.deduped = 0
+        self._lock = threading.Lock()
+
+    def plan(self, list_of_cmds):
+        """
+        Split (id, msg, email) triplets into the commands to run and a
+        {run id: [ids sharing its answer]} map for the duplicates.
+        """
+
+        unique = list()
+        shared = dict()
+        first = dict()
+        generation = 0
+
+        for (id, msg, email) in list_of_cmds:
+            if not parser.is_read_only(msg):
+                generation += 1
+                unique.append((id, msg, email))
+                continue
+
+            key = (tuple(msg[3:].split()), generation)
+            if key in first:
+                shared.setdefault(first[key], list()).append(id)
+                continue
+
+            first[key] = id
+            unique.append((id, msg, email))
+
+        return unique, shared
+
+    def run(self, execute, list_of_cmds):
+        """
+        Run a batch through `execute` (a parse_command_list) with duplicates
+        collapsed, returning (id, response) pairs for every message
+        """
+
+        unique, shared = self.plan(list_of_cmds)
+
+        response_message = execute(unique)
+        if not shared:
+            return response_message
+
+        duplicates = sum(len(ids) for ids in shared.values())
+        with self._lock:
+            self.deduped += duplicates
+        metrics.commands_deduped.inc(duplicates)
+
+        responses = dict()
+        for (id, response) in response_message:
+            # A chunk generator can only be sent once, keep its chunks
+            if id in shared and not isinstance(response, str):
+                response = list(response)
+            responses[id] = response
+            for other in shared.get(id, ()):
+                responses[other] = response
+
+        return [(id, responses[id]) for (id, msg, email) in list_of_cmds]
@@ -3,98 +3,109 @@
 Stop gap measure to poll WebEx Teams for messages
 """
 
+import time
 from os import environ
-from time import sleep
 
-from webexteamssdk import WebexTeamsAPI
 from webexteamssdk.exceptions import RateLimitWarning, RateLimitError
 from webexteamssdk.generator_containers import GeneratorContainer
-from webexteamssdk.models.immutable import Room, Message
+from webexteamssdk.models.immutable import Message
 
 import parser
-import library
+import outbound
+import metrics
+import startup
+import tracing
+from checkpoint import message_cursor
+from ratelimit import token_bucket
+from scheduler import room_schedule
 
 
-def send_webex_message(webex, room_id, text_to_send):
-    webex.messages.create(roomId=room_id, text=text_to_send)
+def iter_room_messages(webex, room_id, page_size, before_message=None):
+    """
+    Stream messages mentioning the bot, newest to oldest.
 
+    Each page is requested explicitly with beforeMessage instead of relying
+    on the SDK pagination, and no page past the one the caller stops in is
+    ever fetched.
+    """
 
-def send_webex_responses(webex, room_id, msg_list):
-    for (parent_id, msg) in msg_list:
-        webex.messages.create(
-            roomId=room_id, parentId=parent_id, text=msg
+    while True:
+        params = {'mentionedPeople': 'me', 'max': int(page_size)}
+        if before_message:
+            params['beforeMessage'] = before_message
+
+        msg_iter: GeneratorContainer(Message) = webex.messages.list(
+            room_id, **params
         )
-    pass
 
+        count = 0
+        for msg in msg_iter:
+            yield msg
+            before_message = msg.id
+            count += 1
 
-def get_latest_commands(webex, room_id, latest_message_id, max_messages):
-    # It I try to collapse msg_iter into a list, WebEx throws a rate limiting
-    # warning.  So these first few chunks of code are to work around service
-    # challenges.
+            # Don't let the SDK wander into the next page on its own
+            if count >= page_size:
+                break
+
+        # A short page means we reached the oldest message
+        if count < page_size:
+            return
 
-    msg_iter: GeneratorContainer(Message) = webex.messages.list(
-        room_id, mentionedPeople="me", max=int(max_messages)
+
+def get_latest_commands(webex, room_id, cursor, max_messages, page_size=None):
+    """
+    Returns (cursor, commands) where commands is the list of new
+    (id, command, email) triplets, oldest first.
+
+    The scan stops at the cursor message, or at the first message that is
+    not newer than it, so a steady-state poll reads one small page.  At most
+    max_messages are returned if the cursor was lost.
+    """
+
+    # It I try to collapse msg_iter into a list, WebEx throws a rate limiting
+    # warning.  So the messages are streamed and we stop as early as we can.
+    msg_iter = iter_room_messages(
+        webex, room_id, page_size=page_size or max_messages
     )
 
     # If we are just starting up, reset the latest command marker
-    if not latest_message_id:
+    if not cursor:
 
-        # Stupid GeneratorContainer doesn't support indexing
+        # Only the newest message is needed
         for msg in msg_iter:
-            latest_message_id = msg.id
-            return latest_message_id, list()
+            return message_cursor(msg.id, msg.created), list()
 
         # If there happen to be no messages, try again later
         return None, list()
 
-    # Convert the Message list to Python native format
-    commands = {msg.id: (msg.text, msg.personEmail) for msg in msg_iter}
+    latest = None
+    return_commands = list()
 
-    # Python 3.7+ guarantees key order so... get the most recent unread msgs
-    msg_ids: list(int) = list(commands.keys())
+    for msg in msg_iter:
+        if msg.id == cursor.id:
+            break
+        if cursor.created and msg.created and msg.created <= cursor.created:
+            break
 
-    try:
-        latest_idx = msg_ids.index(latest_message_id)
-        new_msg_ids = msg_ids[:latest_idx]
-    except ValueError:
-        new_msg_ids = msg_ids
+        # The messages are sorted newest to oldest, so the first is the latest
+        if latest is None:
+            latest = message_cursor(msg.id, msg.created)
 
-    if len(new_msg_ids) == 0:
-        return latest_message_id, list()
+        # Build the commands to be parsed (id, command, email)
+        return_commands.append((msg.id, str(msg.text), str(msg.personEmail)))
+        tracing.received(msg.id, msg.created)
 
-    # The messages are sorted newest to oldest, so grab latest msg id
-    latest_message_id = new_msg_ids[0]
+        if len(return_commands) >= max_messages:
+            break
 
-    # Now, reverse the order to process commands in order
-    new_msg_ids.reverse()
-
-    # Build the commands to be parsed (id, command, email)
-    return_commands = [
-        (id, str(commands[id][0]), str(commands[id][1])) for id in new_msg_ids
-    ]
-
-    return latest_message_id, return_commands
-
-
-def get_webex_room_id(webex, room_title):
-    # Get roomID for the room
-    room_list: list(Room) = webex.rooms.list()
+    if latest is None:
+        return cursor, list()
 
-    # Search through the list to find all room IDs that match the title
-    all_room_ids = [
-        room.id
-        for room in room_list
-        if room.title == room_title
-    ]
-
-    # We should only find one (application requiremes unique titles)
-    if len(all_room_ids) > 1:
-        raise Exception(
-                        f'Duplicate rooms found for {room_title}',
-                        list(room_list)
-                        )
+    # Now, reverse the order to process commands in order
+    return_commands.reverse()
 
-    return all_room_ids[0] if len(all_room_ids) else 0
+    return latest, return_commands
 
 
 def poller_initialization():
@@ -103,88 +114,188 @@ def poller_initialization():
     if not interval:
         raise Exception('WEBEX_TEAMS_POLLING_INTERVAL env var is required.')
 
-    # Which room are we monitoring?
-    webex_room_title = environ.get('WEBEX_TEAMS_ROOM_TITLE')
-    if not webex_room_title:
-        raise Exception('WEBEX_TEAMS_ROOM_TITLE env var is required.')
+    # A 429 raises RateLimitError and the scheduler holds every room
+    webex = startup.webex_api()
+
+    # One conductor session (and connection pool) shared by all rooms
+    conductor = startup.conductor_service()
+
+    # Do the rooms exist?  List of (title, room ID) pairs
+    webex_rooms = startup.webex_rooms(webex)
 
-    # Make sure our secure token is loaded
-    if not environ.get('WEBEX_TEAMS_ACCESS_TOKEN'):
-        raise Exception('WEBEX_TEAMS_ACCESS_TOKEN env var is required.')
+    return webex, webex_rooms, int(interval), conductor
 
-    # Check for conductor service environment variables, else default
-    svc_proto = environ.get('CONDUCTOR_PROTO', 'http')
-    svc_host = environ.get('CONDUCTOR_HOST', 'localhost')
-    svc_port = environ.get('CONDUCTOR_PORT', '8000')
 
-    conductor = library.conductor_service(
-        proto=svc_proto, host=svc_host, port=svc_port
+def poll_room(webex, room, dispatch, replies, state=None):
+    """
+    Poll a single room once: fetch new commands, run them and queue the
+    replies.  room is the per-room dict built in __main__ (id, cursor,
+    page_size, catchup).  Returns the number of new commands.
+    """
+
+    room_id = room['id']
+    cursor = room['cursor']
+
+    start = time.perf_counter()
+    with tracing.span('fetch', source=room['title']) as span:
+        cursor, command_message_list = get_latest_commands(
+            webex, room_id, cursor,
+            max_messages=(room['catchup'] or 25) if cursor else 1,
+            page_size=room['page_size'] if cursor else 1,
+        )
+        span.attach(id for (id, msg, email) in command_message_list)
+    metrics.poll_seconds.observe(
+        time.perf_counter() - start, source=room['title']
     )
+    metrics.poll_messages.observe(
+        len(command_message_list), source=room['title']
+    )
+    room['cursor'] = cursor
+    room['catchup'] = 0
+
+    # Size the next page for the traffic we just saw (plus the cursor)
+    room['page_size'] = min(25, max(2, 2 * len(command_message_list) + 1))
 
-    # Load up WebexTeams API instance
-    webex = WebexTeamsAPI()
+    # Skip anything already answered before a restart
+    if state:
+        command_message_list = state.unfinished(command_message_list)
+        state.received(room_id, command_message_list)
 
-    # Does the room exist?
-    webex_room_id = get_webex_room_id(webex, webex_room_title)
-    if webex_room_id == 0:
-        raise Exception('Room "{webex_room_title}" not found.')
+    # A list of (id, response) pairs - id to be used for 'parentId'.  A
+    # failed batch is still answered, so the cursor always moves on and a
+    # restart never runs the same command again
+    try:
+        response_message = dispatch(command_message_list)
+    except Exception as err:
+        print(f'Batch for {room["title"]} failed: {err!r}')
+        response_message = [
+            (id, parser.COMMAND_ERROR) for (id, msg, email) in
+            command_message_list
+        ]
+
+    # Checkpoint responses and cursor before the replies go out
+    if state:
+        state.processed(room_id, response_message)
+        state.save_cursor(room_id, cursor)
+        state.flush()
+
+    replies.put_responses(room_id, response_message)
 
-    return webex, webex_room_title, webex_room_id, int(interval), conductor
+    if response_message:
+        print(room['title'], [
+            (id, outbound.describe(response))
+            for (id, response) in response_message
+        ])
+
+    return len(command_message_list)
 
 
 if __name__ == '__main__':
 
     # Get initial setup information
-    webex, webex_room_title, webex_room_id, interval, conductor = poller_initialization() # noqa
+    webex, webex_rooms, interval, conductor = poller_initialization()
+
+    # Cursor and journal, if state is kept across restarts
+    state = startup.checkpoint_store()
 
-    # Since we are restarting the application, announce to the space
-    webex.messages.create(
-        roomId=webex_room_id,
-        text=f'Service is restarting. Polling interval {interval}s.'
+    dispatch = startup.batch_dispatcher(conductor)
+    replies = startup.reply_queue(webex, state)
+    startup.reservation_index(
+        conductor, webex, [room_id for (title, room_id) in webex_rooms],
+        replies, state
+    )
+    startup.observability(replies, conductor)
+
+    # After a restart, catch up on everything since the checkpoint
+    catchup = int(environ.get('WEBEX_TEAMS_CATCHUP_MAX', '200'))
+
+    # Per-room polling state, keyed by room ID
+    room_state = dict()
+    for (title, room_id) in webex_rooms:
+        cursor = state.load_cursor(room_id) if state else None
+        room_state[room_id] = {
+            'id': room_id,
+            'title': title,
+            'cursor': cursor,
+            'page_size': 25 if cursor else 2,
+            'catchup': catchup,
+        }
+
+        # Since we are restarting the application, announce to the space
+        resuming = ' Resuming from last checkpoint.' if cursor else ''
+        replies.put(
+            room_id,
+            f'Service is restarting. Polling interval {interval}s.{resuming}'
+        )
+
+        # Replies computed before the restart that never made it out, and
+        # chunked replies (not stored) computed again
+        if state:
+            replies.put_responses(room_id, state.unsent(room_id))
+            resend = dispatch(state.resend(room_id))
+            state.processed(room_id, resend)
+            replies.put_responses(room_id, resend)
+
+    # Poll busy rooms fast, back off to the polling interval when idle.
+    # The budget caps messages.list calls per minute across all rooms.
+    budget = float(environ.get('WEBEX_TEAMS_POLLING_BUDGET', '60'))
+    schedule = room_schedule(
+        list(room_state),
+        minimum=float(environ.get('WEBEX_TEAMS_POLLING_MIN', '1')),
+        maximum=float(environ.get('WEBEX_TEAMS_POLLING_MAX', interval)),
+        backoff=float(environ.get('WEBEX_TEAMS_POLLING_BACKOFF', '2')),
+        budget=token_bucket(rate=budget / 60.0, burst=1),
+    )
+
+    # The adaptive interval of every room, as scraped
+    metrics.default_registry.gauge(
+        'poller_poll_interval_seconds', 'Current polling interval per room',
+        lambda: {
+            (room['title'],): schedule.interval(room_id)
+            for room_id, room in room_state.items()
+        },
+        labels=('room',)
     )
 
-    latest_message_id = None
-    poll_wait = interval
-    print('Starting the polling...')
+    print(f'Starting the polling of {len(room_state)} room(s)...')
 
     # Start the polling...
     while True:
+        room_id = schedule.next_room()
+        metrics.loop_lag_seconds.observe(schedule.lag)
+        message_count = 0
 
-        # Grab the latest messages - list of (id, msg) pairs
+        # Grab the latest messages, run them and queue the replies
         try:
-            latest_message_id, command_message_list = get_latest_commands(
-                webex, webex_room_id, latest_message_id,
-                max_messages=25 if latest_message_id else 1,
+            message_count = poll_room(
+                webex, room_state[room_id], dispatch, replies, state
             )
 
-            # Okay, we didn't perturb Happy Fun Ball, resume normal polling.
-            poll_wait = interval
-
-            # A list of (id, response) pairs - id to be used for 'parentId'
-            response_message = parser.parse_command_list(
-                conductor, command_message_list
-            )
-            send_webex_responses(webex, webex_room_id, response_message)
-
-            print(response_message)
+            if replies.depth:
+                print(f'Reply queue depth: {replies.depth}')
 
         # Uh oh, Happy Fun Ball is perturbed.
         except RateLimitWarning as rlw:
             warning_msg = f'Rate Limit Warning: {rlw.retry_after}'
             print(warning_msg)
-            send_webex_message(webex, webex_room_id, warning_msg)
-            poll_wait = interval + int(rlw.retry_after)
+            metrics.rate_limits.inc(source='poll')
+            replies.put(room_id, warning_msg)
+            schedule.penalize(int(rlw.retry_after))
 
-        # Now, Happy Fun Ball is smoking. Run far away.
+        # Now, Happy Fun Ball is smoking. Run far away (all rooms share the
+        # token, so every room waits)
         except RateLimitError as rle:
             error_msg = f'Rate Limit Error: {rle.retry_after}'
-            print(error_msg, 'Sleeping for a while...')
-
-            sleep(rle.retry_after)
-            send_webex_message(webex, webex_room_id, error_msg)
+            print(error_msg, 'Holding all polling for a while...')
+            metrics.rate_limits.inc(source='poll')
+            replies.put(room_id, error_msg)
 
             # And back off some more, just to be kind
-            poll_wait = interval + int(rle.retry_after)
+            schedule.penalize(interval + int(rle.retry_after))
 
         finally:
-            sleep(poll_wait)
+            before = schedule.interval(room_id)
+            schedule.record(room_id, message_count)
+            if schedule.interval(room_id) != before:
+                print(f'{room_state[room_id]["title"]}: polling every '
+                      f'{schedule.interval(room_id):g}s')
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Token bucket used to stay under the Webex API rate limits
+"""
+
+import threading
+import time
+
+
+class token_bucket:
+    """
+    Allows `rate` calls per second on average with bursts up to `burst`.
+
+    pause() empties the bucket and holds every caller for a while, which is
+    what we want after a 429 with a Retry-After header.
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.clock = clock
+        self.sleep = sleep
+
+        self._tokens = self.burst
+        self._updated = clock()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        # No tokens accrue while paused
+        elapsed = max(0.0, now - max(self._updated, self._paused_until))
+        self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+        self._updated = now
+
+    def try_acquire(self):
+        """Take a token if one is available right now, never blocks"""
+        with self._lock:
+            now = self.clock()
+            self._refill(now)
+
+            if now < self._paused_until or self._tokens < 1.0:
+                return False
+
+            self._tokens -= 1.0
+            return True
+
+    def acquire(self):
+        """Block until a token is available, then take it"""
+        while True:
+            with self._lock:
+                now = self.clock()
+                self._refill(now)
+
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                else:
+                    wait = (1.0 - self._tokens) / self.rate
+
+            self.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            now = self.clock()
+            self._paused_until = max(self._paused_until, now + float(seconds))
+            self._tokens = 0.0
+            self._updated = now
+
+    @property
+    def available(self):
+        with self._lock:
+            self._refill(self.clock())
+            return self._tokens
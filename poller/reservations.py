@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+In-process index of the conductor reservations
+
+A background thread refreshes the index from /reserve/project/ every
+`refresh` seconds.  The list is a conditional GET, so an unchanged list
+costs a 304.  The list only has (project, email) pairs, so details are
+fetched, uncached, only for pairs that were not listed last time.
+Each reservation's expiry is kept as an absolute time, so `reserve list`
+can be answered locally with the time remaining computed on the spot.
+
+Expiries are also kept in a heap: `notice` seconds before a reservation
+runs out, its owner is mentioned in the notification room.  With a checkpoint
+store the notified lease IDs are kept there, so a restart neither repeats
+a notice nor skips one that fell due while it was down.  Without one, only
+notices still ahead at the first refresh are sent.
+"""
+
+import heapq
+import threading
+import time
+
+import requests
+
+import rooms
+
+
+# Markdown, the mention is what actually notifies the owner
+NOTICE_TEXT = (
+    '<@personEmail:{email}>: your reservation of project {project} expires in '
+    '{minutes} minute(s).  Cancel it with "reserve cancel {project}" if '
+    'you are done, or reserve it again when it runs out.'
+)
+
+
+def notify_room(webex, room_ids, title=None):
+    """Room ID for expiry notices: the room titled `title`, else the first"""
+    if title:
+        return rooms.get_webex_room_ids(webex, [title])[title]
+    return room_ids[0]
+
+
+class reservation_index:
+    def __init__(
+        self, session, refresh=30.0, notice=600.0, page_size=100,
+        state=None, clock=time.time
+    ):
+        self.session = session
+        self.state = state
+        self.refresh_interval = float(refresh)
+        self.notice = float(notice)
+        self.page_size = int(page_size)
+        self.clock = clock
+
+        self.refreshed_at = None
+        self.notified = 0
+        self.lookups = 0
+
+        # (project, email) pairs of the last list
+        self._listed = set()
+
+        # project -> {'project', 'email', 'id', 'expires', 'seen'}
+        self._entries = dict()
+
+        # (notice due, sequence, project, lease id), stale items skipped
+        self._notices = list()
+        self._sequence = 0
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def ready(self):
+        """Has the index been refreshed recently enough to answer from?"""
+        if self.refreshed_at is None:
+            return False
+        return self.clock() - self.refreshed_at < 3 * self.refresh_interval
+
+    def _add(self, payload, now, late_notice=True):
+        entry = {
+            'project': payload['project'],
+            'email': payload['email'],
+            'id': payload['id'],
+            'expires': now + float(payload['ttl']),
+            'seen': now,
+        }
+        self._entries[entry['project']] = entry
+
+        # A reservation made shorter than the notice needs no reminder
+        notice_at = entry['expires'] - self.notice
+        if self.notice > 0 and (late_notice or notice_at > now):
+            heapq.heappush(self._notices, (
+                notice_at, self._sequence, entry['project'], entry['id']
+            ))
+            self._sequence += 1
+
+    def update(self, payload):
+        """A reservation created through this service (a Reservation)"""
+        with self._lock:
+            self._add(payload, self.clock(), late_notice=False)
+
+    def remove(self, project):
+        """A reservation cancelled through this service"""
+        with self._lock:
+            self._entries.pop(project, None)
+
+    def refresh(self):
+        """Bring the index up to date with the conductor's list"""
+        now = self.clock()
+        listed = dict()
+        for page in self.session.get_pages(
+            '/reserve/project/', self.page_size
+        ):
+            for item in page:
+                listed[item['project']] = item
+
+        with self._lock:
+            indexed = dict(self._entries)
+
+        # Details only for pairs new since the last list (none at all when
+        # it came back unchanged), bypassing the cache so the ttl is current
+        fresh = dict()
+        for project, item in listed.items():
+            entry = indexed.get(project)
+            if entry and (project, item['email']) in self._listed and \
+                    entry['id'] == item.get('id', entry['id']):
+                continue
+
+            if 'ttl' in item and 'id' in item:
+                fresh[project] = item
+                continue
+
+            try:
+                fresh[project] = self.session.get(
+                    f'/reserve/project/{project}', cached=False
+                )
+                self.lookups += 1
+            except requests.HTTPError:
+                # Cancelled since the list was fetched
+                continue
+
+        with self._lock:
+            # Keep reservations made while the list was being fetched
+            for project, entry in list(self._entries.items()):
+                if project not in listed and entry['seen'] <= now:
+                    del self._entries[project]
+            for payload in fresh.values():
+                self._add(payload, now, late_notice=self.state is not None)
+            self.refreshed_at = now
+
+        self._listed = {
+            (project, item['email']) for project, item in listed.items()
+        }
+
+    def get(self, project):
+        """Reservation payload with the remaining ttl, None if not indexed"""
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(project)
+
+        if entry is None or entry['expires'] <= now:
+            return None
+
+        return {
+            'project': entry['project'],
+            'email': entry['email'],
+            'id': entry['id'],
+            'ttl': int(entry['expires'] - now),
+        }
+
+    def all(self):
+        """Every unexpired reservation, as ReservationCore payloads"""
+        now = self.clock()
+        with self._lock:
+            return [
+                {'project': entry['project'], 'email': entry['email']}
+                for entry in self._entries.values() if entry['expires'] > now
+            ]
+
+    def due(self):
+        """Pop the reservations whose expiry notice is due"""
+        now = self.clock()
+        expiring = list()
+
+        with self._lock:
+            while self._notices and self._notices[0][0] <= now:
+                _, _, project, lease_id = heapq.heappop(self._notices)
+
+                entry = self._entries.get(project)
+                if entry is None or entry['id'] != lease_id or \
+                        entry['expires'] <= now:
+                    continue
+
+                expiring.append(entry)
+
+        return expiring
+
+    def next_due(self):
+        """Seconds until the next expiry notice (None if there is none)"""
+        with self._lock:
+            if not self._notices:
+                return None
+            return max(0.0, self._notices[0][0] - self.clock())
+
+    def start(self, notify):
+        """
+        Refresh and send expiry notices from a background thread.
+        notify(markdown) is called with each notice.
+        """
+
+        def run():
+            next_refresh = 0.0
+            while not self._stop.is_set():
+                if self.clock() >= next_refresh:
+                    try:
+                        self.refresh()
+                    except Exception as err:
+                        print(f'Reservation index refresh failed: {err}')
+                    next_refresh = self.clock() + self.refresh_interval
+
+                for entry in self.due():
+                    if self.state and self.state.noticed(entry['id']):
+                        continue
+
+                    minutes = max(
+                        1, round((entry['expires'] - self.clock()) / 60)
+                    )
+                    notify(NOTICE_TEXT.format(minutes=minutes, **entry))
+                    self.notified += 1
+
+                    if self.state:
+                        self.state.notice_sent(entry['id'])
+                        self.state.flush()
+
+                wait = next_refresh - self.clock()
+                upcoming = self.next_due()
+                if upcoming is not None:
+                    wait = min(wait, upcoming)
+                self._stop.wait(max(0.05, wait))
+
+        self._thread = threading.Thread(
+            target=run, name='reservations', daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Webex room lookup shared by poller.py and buffer.py
+
+Listing every room the bot belongs to is slow once the bot is in hundreds
+of rooms, so resolved title -> room ID pairs can be kept in a small JSON
+index on disk.  A cached room is validated with one rooms.get call and the
+full listing only happens on a miss or when validation fails.
+"""
+
+import json
+import os
+from os import environ
+
+from webexteamssdk.exceptions import ApiError
+from webexteamssdk.models.immutable import Room
+
+
+def room_titles():
+    """
+    Titles of the rooms to monitor.
+
+    WEBEX_TEAMS_ROOM_TITLES holds several titles separated by ';', else the
+    single WEBEX_TEAMS_ROOM_TITLE is used.
+    """
+
+    titles = environ.get('WEBEX_TEAMS_ROOM_TITLES')
+    if titles:
+        return [title.strip() for title in titles.split(';') if title.strip()]
+
+    title = environ.get('WEBEX_TEAMS_ROOM_TITLE')
+    if not title:
+        raise Exception('WEBEX_TEAMS_ROOM_TITLE env var is required.')
+
+    return [title]
+
+
+def get_webex_room_ids(webex, room_titles):
+    """
+    Map each title to its room ID (0 if not found) with a single pass over
+    the rooms the bot belongs to.
+    """
+
+    room_list: list(Room) = list(webex.rooms.list(max=1000))
+
+    room_ids = dict()
+    for title in room_titles:
+        # Search through the list to find all room IDs that match the title
+        all_room_ids = [room.id for room in room_list if room.title == title]
+
+        # We should only find one (application requiremes unique titles)
+        if len(all_room_ids) > 1:
+            raise Exception(
+                            f'Duplicate rooms found for {title}',
+                            room_list
+                            )
+
+        room_ids[title] = all_room_ids[0] if len(all_room_ids) else 0
+
+    return room_ids
+
+
+def load_room_index(path):
+    try:
+        with open(path) as index_file:
+            return dict(json.load(index_file))
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_room_index(path, index):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+
+    # Write then rename so a crash never leaves a truncated index
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w') as index_file:
+        json.dump(index, index_file, indent=2)
+    os.replace(temp_path, path)
+
+
+def validate_room(webex, room_id, room_title):
+    """True if the bot can still see room_id and it still has that title"""
+    try:
+        room: Room = webex.rooms.get(room_id)
+    except ApiError:
+        return False
+
+    return room.title == room_title
+
+
+def resolve_rooms(webex, room_titles, index_path=None):
+    """
+    List of (title, room ID) pairs, raising if any room is missing.
+
+    With index_path, cached rooms are validated individually and only the
+    titles that miss (or fail validation) trigger a full rooms listing,
+    which also checks for duplicate titles.
+    """
+
+    index = load_room_index(index_path) if index_path else dict()
+
+    room_ids = dict()
+    for title in room_titles:
+        room_id = index.get(title)
+        if room_id and validate_room(webex, room_id, title):
+            room_ids[title] = room_id
+
+    missing = [title for title in room_titles if title not in room_ids]
+    if missing:
+        room_ids.update(get_webex_room_ids(webex, missing))
+
+    for title, room_id in room_ids.items():
+        if room_id == 0:
+            raise Exception(f'Room "{title}" not found.')
+
+    if index_path and missing:
+        index.update({title: room_ids[title] for title in missing})
+        save_room_index(index_path, index)
+
+    return [(title, room_ids[title]) for title in room_titles]
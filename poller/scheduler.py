@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Polling schedule for the Webex rooms
+
+Poll quickly right after activity, back off exponentially towards a
+ceiling while the room is idle, and never exceed the API call budget.
+"""
+
+import heapq
+import time
+
+
+class adaptive_interval:
+    def __init__(self, minimum=1.0, maximum=15.0, backoff=2.0):
+        self.minimum = float(minimum)
+        self.maximum = max(self.minimum, float(maximum))
+        self.backoff = max(1.0, float(backoff))
+
+        # Seconds until the next poll
+        self.interval = self.minimum
+
+    def record(self, message_count):
+        """Adjust the interval from how many new messages the last poll saw"""
+        if message_count:
+            self.interval = self.minimum
+        else:
+            self.interval = min(self.maximum, self.interval * self.backoff)
+
+        return self.interval
+
+
+class room_schedule:
+    """
+    Spread polls over several rooms sharing one API call budget.
+
+    Every room keeps its own adaptive_interval, so a busy room comes due
+    again after the minimum interval while idle rooms drift towards the
+    ceiling.  Rooms are polled earliest-due first.
+    """
+
+    def __init__(
+        self, rooms, minimum=1.0, maximum=15.0, backoff=2.0, budget=None,
+        clock=time.monotonic, sleep=time.sleep
+    ):
+        self.budget = budget
+        self.clock = clock
+        self.sleep = sleep
+
+        self.intervals = {
+            room: adaptive_interval(minimum, maximum, backoff)
+            for room in rooms
+        }
+
+        # (due time, sequence, room), first polls staggered over `minimum`
+        now = clock()
+        step = float(minimum) / max(1, len(self.intervals))
+        self._heap = [
+            (now + idx * step, idx, room)
+            for idx, room in enumerate(self.intervals)
+        ]
+        self._sequence = len(self._heap)
+
+        # Seconds the last next_room() returned after its room was due
+        self.lag = 0.0
+
+    def next_room(self):
+        """Block until the next room is due (and budget allows), return it"""
+        due, _, room = heapq.heappop(self._heap)
+
+        delay = due - self.clock()
+        if delay > 0:
+            self.sleep(delay)
+
+        if self.budget:
+            self.budget.acquire()
+
+        self.lag = max(0.0, self.clock() - due)
+        return room
+
+    def record(self, room, message_count):
+        """Reschedule a room returned by next_room() after polling it"""
+        interval = self.intervals[room]
+        interval.record(message_count)
+
+        due = self.clock() + interval.interval
+
+        heapq.heappush(self._heap, (due, self._sequence, room))
+        self._sequence += 1
+
+    def penalize(self, retry_after):
+        """Rate limits apply to the whole token, so hold every room"""
+        if self.budget:
+            self.budget.pause(retry_after)
+        else:
+            self.sleep(float(retry_after))
+
+    def interval(self, room):
+        return self.intervals[room].interval
@@ -1,20 +1,42 @@
 #!/usr/bin/env python3
 
 
+import re
+from functools import lru_cache
+
 from pydantic import BaseModel, EmailStr
 from pydantic import validator
-import validators
+
+
+# Characters allowed in a single URL path segment (RFC 3986 pchar, plus the
+# non-ASCII ranges the previous validators.url check accepted)
+PATH_SEGMENT = re.compile(
+    "[-a-z0-9._~%!$&'()*+,;=:@\u00a1-\uffff\U00010000-\U0010ffff]+"
+)
+
+
+@lru_cache(maxsize=1024)
+def is_valid_path_segment(param: str) -> bool:
+    return PATH_SEGMENT.fullmatch(param) is not None
 
 
 # Validator methods
 def valid_url_path(param: str) -> str:
     if not param.islower():
         raise ValueError("name must be valid URL path, must be lowercase")
-    if not validators.url(f'http://localhost/{param}'):
+    if not is_valid_path_segment(param):
         raise ValueError("name must be a valid URL path, URL path invalid")
     return param
 
 
+def trusted(model, payload):
+    """
+    Build a model from a conductor response without validating it again
+    (the conductor validated it on the way in)
+    """
+    return model.construct(**payload)
+
+
 # Service schema models
 class Version(BaseModel):
     version: str
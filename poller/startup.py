@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Start-up shared by poller.py, buffer.py and webhook.py
+
+Each builds its Webex client, conductor session, command dispatcher, reply
+queue, reservation index, metrics and tracing the same way, from the same
+environment variables (see the README).  Only the ingestion differs.
+"""
+
+from os import environ
+
+from webexteamssdk import WebexTeamsAPI
+from webexteamssdk.config import DEFAULT_BASE_URL
+
+import library
+import engine
+import outbound
+import dedup
+import admission
+import fairness
+import planner
+import reservations
+import checkpoint
+import rooms
+import metrics
+import tracing
+
+
+def webex_api():
+    # Make sure our secure token is loaded
+    if not environ.get('WEBEX_TEAMS_ACCESS_TOKEN'):
+        raise Exception('WEBEX_TEAMS_ACCESS_TOKEN env var is required.')
+
+    # A 429 raises RateLimitError instead of sleeping inside the SDK, so the
+    # poll scheduler and the reply queue can pause (and count it) themselves.
+    # WEBEX_TEAMS_BASE_URL points at a proxy or a local stand-in
+    return WebexTeamsAPI(
+        wait_on_rate_limit=False,
+        base_url=environ.get('WEBEX_TEAMS_BASE_URL', DEFAULT_BASE_URL)
+    )
+
+
+def webex_rooms(webex):
+    """The monitored rooms, as a list of (title, room ID) pairs"""
+    return rooms.resolve_rooms(
+        webex, rooms.room_titles(), environ.get('WEBEX_TEAMS_ROOM_INDEX')
+    )
+
+
+def conductor_service():
+    # Check for conductor service environment variables, else default
+    return library.conductor_service(
+        proto=environ.get('CONDUCTOR_PROTO', 'http'),
+        host=environ.get('CONDUCTOR_HOST', 'localhost'),
+        port=environ.get('CONDUCTOR_PORT', '8000'),
+        cache_size=int(environ.get('CONDUCTOR_CACHE_SIZE', '256')),
+        connect_timeout=float(environ.get('CONDUCTOR_CONNECT_TIMEOUT', '3.05')),
+        read_timeout=float(environ.get('CONDUCTOR_READ_TIMEOUT', '10')),
+        pool_size=int(environ.get('CONDUCTOR_POOL_SIZE', '16')),
+        retries=int(environ.get('CONDUCTOR_RETRIES', '3')),
+        deadline=float(environ.get('CONDUCTOR_DEADLINE', '20')),
+        breaker_failures=int(environ.get('CONDUCTOR_BREAKER_FAILURES', '5')),
+        breaker_reset=float(environ.get('CONDUCTOR_BREAKER_RESET', '30')),
+        validator_size=int(environ.get('CONDUCTOR_VALIDATOR_SIZE', '1024')),
+    )
+
+
+def checkpoint_store():
+    """Cursor and journal kept across restarts, None unless configured"""
+    state_path = environ.get('POLLER_STATE_PATH')
+    if not state_path:
+        return None
+
+    state = checkpoint.checkpoint_store(state_path)
+    state.prune()
+    return state
+
+
+def batch_dispatcher(conductor):
+    # Commands in a batch processed concurrently (1 == in series)
+    return engine.batch_dispatcher(
+        conductor,
+        concurrency=int(environ.get('COMMAND_CONCURRENCY', '1')),
+        executor=environ.get('COMMAND_EXECUTOR', 'asyncio'),
+        guard=dedup.duplicate_guard(
+            capacity=int(environ.get('DEDUP_CAPACITY', '1000000')),
+            error_rate=float(environ.get('DEDUP_ERROR_RATE', '1e-6')),
+            max_bytes=int(environ.get('DEDUP_MAX_BYTES', '16777216')),
+        ),
+        admission=admission.admission_queue(
+            max_pending=int(environ.get('ADMISSION_MAX', '50'))
+        ),
+        fairness=fairness.fair_scheduler(
+            weights=fairness.parse_weights(environ.get('USER_WEIGHTS')),
+            user_rate=float(environ.get('USER_RATE', '30')),
+            user_burst=int(environ.get('USER_BURST', '10')),
+        ),
+        planner=planner.query_planner(),
+    )
+
+
+def reply_queue(webex, state=None):
+    # Replies are sent in the background, separate from the ingestion
+    return outbound.reply_queue(
+        webex,
+        workers=int(environ.get('WEBEX_REPLY_WORKERS', '4')),
+        rate=float(environ.get('WEBEX_REPLY_RATE', '5')),
+        burst=int(environ.get('WEBEX_REPLY_BURST', '10')),
+        on_sent=state.replied if state else None,
+        on_failed=state.failed if state else None,
+    ).start()
+
+
+def reservation_index(conductor, webex, room_ids, replies, state=None):
+    # Reservations answered locally, with expiry notices, unless disabled
+    refresh = float(environ.get('RESERVATION_REFRESH', '30'))
+    if refresh <= 0:
+        return
+
+    notice_room = reservations.notify_room(
+        webex, room_ids, environ.get('RESERVATION_NOTIFY_ROOM')
+    )
+    conductor.reservations = reservations.reservation_index(
+        conductor, refresh=refresh,
+        notice=60 * float(environ.get('RESERVATION_NOTICE_MINUTES', '10')),
+        state=state,
+    ).start(lambda text: replies.put(notice_room, text, markdown=True))
+
+
+def observability(replies, conductor):
+    # Prometheus metrics on a local port, if asked for
+    metrics_port = environ.get('METRICS_PORT')
+    if metrics_port:
+        metrics.default_registry.gauge(
+            'poller_reply_queue_depth', 'Replies waiting to be sent',
+            lambda: replies.depth
+        )
+        metrics.default_registry.gauge(
+            'poller_conductor_cache',
+            'Conductor GET cache hits, misses, evictions and entries',
+            lambda: {
+                (stat,): value
+                for stat, value in conductor.cache.stats().items()
+            },
+            labels=('stat',)
+        )
+        metrics.default_registry.gauge(
+            'poller_conductor_revalidated',
+            'Conductor GETs answered by a 304 from the stored payload',
+            lambda: conductor.validators.revalidated
+        )
+        metrics.serve(environ.get('METRICS_HOST', '127.0.0.1'), metrics_port)
+
+    # Per-message traces to a rotating JSON-lines file, if asked for
+    trace_path = environ.get('TRACE_PATH')
+    if trace_path:
+        tracing.configure(
+            trace_path,
+            sample_rate=float(environ.get('TRACE_SAMPLE_RATE', '1')),
+            tail_ms=environ.get('TRACE_TAIL_MS'),
+            max_bytes=int(environ.get('TRACE_MAX_BYTES', '10485760')),
+            backups=int(environ.get('TRACE_BACKUPS', '3')),
+        )
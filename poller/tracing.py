@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Per-message tracing: poll -> parse -> conductor -> reply
+
+Every message ID gets a trace made of spans (fetch, dispatch, command,
+conductor, reply_wait, reply).  Batch spans such as a poll are shared by
+all the messages they carry.  A trace is held in memory until its reply
+has gone out, then written to a rotating JSON-lines file, one line per
+span.  Traces are sampled by message ID, and in tail mode only traces
+slower than a threshold are written.
+
+Tracing is off until configure() is called; the module functions then
+return a shared no-op span, so the instrumented code costs a function call.
+"""
+
+import contextvars
+import datetime
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from logging.handlers import RotatingFileHandler
+
+
+# Message ID the code running in this thread/task is working for
+current_message = contextvars.ContextVar('current_message', default=None)
+
+
+class noop_span:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def attach(self, message_ids):
+        pass
+
+    def set(self, **attrs):
+        pass
+
+
+class trace_span:
+    def __init__(self, tracer, name, message_ids, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.message_ids = message_ids
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.time()
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+
+        message_ids = self.message_ids
+        if message_ids is None:
+            message_id = current_message.get()
+            message_ids = [message_id] if message_id else ()
+
+        self.tracer.add(self.name, message_ids, self.start, end, self.attrs)
+        return False
+
+    def attach(self, message_ids):
+        """Set the messages a batch span belongs to, once they are known"""
+        self.message_ids = list(message_ids)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+def timestamp(value):
+    """Epoch seconds from a datetime or ISO 8601 string (Webex created)"""
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    try:
+        return datetime.datetime.fromisoformat(
+            str(value).replace('Z', '+00:00')
+        ).timestamp()
+    except ValueError:
+        return None
+
+
+class tracer:
+    def __init__(
+        self, path, sample_rate=1.0, tail_ms=None, max_bytes=10485760,
+        backups=3, max_open=10000
+    ):
+        self.sample_rate = max(0.0, min(1.0, float(sample_rate)))
+        self.tail = float(tail_ms) / 1000.0 if tail_ms else None
+        self.max_open = int(max_open)
+
+        self.written = 0
+        self.dropped = 0
+
+        # message ID -> [trace start, [span records]], oldest first
+        self._traces = OrderedDict()
+        self._lock = threading.Lock()
+        self._span_ids = itertools.count(1)
+
+        handler = RotatingFileHandler(
+            path, maxBytes=int(max_bytes), backupCount=int(backups)
+        )
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self._log = logging.getLogger(f'poller.tracing.{id(self)}')
+        self._log.propagate = False
+        self._log.setLevel(logging.INFO)
+        self._log.addHandler(handler)
+
+    def sampled(self, message_id):
+        # Hash based, so every replica samples the same messages
+        if self.sample_rate >= 1.0:
+            return True
+        return zlib.crc32(message_id.encode()) < self.sample_rate * 2 ** 32
+
+    def _trace(self, message_id, start):
+        trace = self._traces.get(message_id)
+        if trace is None:
+            if not self.sampled(message_id):
+                return None
+
+            trace = self._traces[message_id] = [start, list()]
+            if len(self._traces) > self.max_open:
+                # Never replied (dropped as a duplicate, crashed batch...)
+                self._traces.popitem(last=False)
+                self.dropped += 1
+
+        return trace
+
+    def add(self, name, message_ids, start, end, attrs):
+        record = {
+            'span': name,
+            'span_id': next(self._span_ids),
+            'start': round(start, 6),
+            'duration_ms': round((end - start) * 1000.0, 3),
+        }
+        if len(message_ids) > 1:
+            record['batch'] = len(message_ids)
+        record.update(attrs)
+
+        with self._lock:
+            for message_id in message_ids:
+                trace = self._trace(message_id, start)
+                if trace is not None:
+                    trace[0] = min(trace[0], start)
+                    trace[1].append(record)
+
+    def received(self, message_id, created=None):
+        """Start a trace, with the time spent waiting since `created`"""
+        created = timestamp(created)
+        now = time.time()
+
+        if created is not None and created < now:
+            self.add('wait', [message_id], created, now, dict())
+        else:
+            with self._lock:
+                self._trace(message_id, now)
+
+    def finish(self, message_id, **attrs):
+        """The reply is out (or failed): write the trace, or drop it"""
+        with self._lock:
+            trace = self._traces.pop(message_id, None)
+        if trace is None:
+            return
+
+        start, records = trace
+        total = time.time() - start
+        if self.tail is not None and total < self.tail:
+            return
+
+        pid = os.getpid()
+        for record in records:
+            line = dict(record, trace=message_id, pid=pid)
+            line['total_ms'] = round(total * 1000.0, 3)
+            line.update(attrs)
+            self._log.info(json.dumps(line, default=str))
+
+        self.written += 1
+
+
+_noop = noop_span()
+_active = None
+
+
+def configure(path, sample_rate=1.0, tail_ms=None, max_bytes=10485760,
+              backups=3):
+    global _active
+    _active = tracer(path, sample_rate, tail_ms, max_bytes, backups)
+    return _active
+
+
+def span(name, message_ids=None, **attrs):
+    """
+    Time a block as part of the given messages' traces, or of the message
+    set by message() when message_ids is None
+    """
+    if _active is None:
+        return _noop
+    return trace_span(_active, name, message_ids, attrs)
+
+
+class message_scope:
+    def __init__(self, message_id):
+        self.message_id = message_id
+
+    def __enter__(self):
+        self._token = current_message.set(self.message_id)
+        return self
+
+    def __exit__(self, *exc):
+        current_message.reset(self._token)
+        return False
+
+
+def message(message_id):
+    """Run a block on behalf of one message (conductor calls are traced)"""
+    if _active is None:
+        return _noop
+    return message_scope(message_id)
+
+
+def received(message_id, created=None):
+    if _active is not None:
+        _active.received(message_id, created)
+
+
+def record(name, message_id, start, end, **attrs):
+    if _active is not None:
+        _active.add(name, [message_id], start, end, attrs)
+
+
+def finish(message_id, **attrs):
+    if _active is not None:
+        _active.finish(message_id, **attrs)
+
+
+def enabled():
+    return _active is not None
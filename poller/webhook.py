@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Webhook ingestion: receive Webex "messages created" events directly
+
+Instead of polling Webex (poller.py) or the buffer service (buffer.py),
+run a small HTTP server that Webex posts webhook events to.  Each event is
+checked against the webhook secret (X-Spark-Signature, HMAC-SHA1 of the
+raw body), the message text is fetched with messages.get, and the commands
+are fed to the parser as soon as they arrive.
+"""
+
+import hashlib
+import hmac
+import json
+import queue
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import environ
+
+from webexteamssdk.exceptions import ApiError, RateLimitError
+
+import engine
+import parser
+import metrics
+import startup
+import tracing
+
+
+def verify_signature(secret, body, signature):
+    if not secret or not signature:
+        return False
+
+    expected = hmac.new(secret.encode(), body, hashlib.sha1).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+def parse_event(body):
+    """
+    Returns (message ID, room ID, email) for a messages/created event, None
+    for anything else.  The event shape is the webhook envelope around
+    data as in research/example.message.json (without the text).
+    """
+
+    event = json.loads(body)
+
+    if event.get('resource') != 'messages' or event.get('event') != 'created':
+        return None
+
+    data = event.get('data', dict())
+    if 'id' not in data or 'roomId' not in data:
+        return None
+
+    return (data['id'], data['roomId'], data.get('personEmail'))
+
+
+class webhook_handler(BaseHTTPRequestHandler):
+    # Set on the server instance: secret, events (queue), room_ids, bot_email
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+
+        signature = self.headers.get('X-Spark-Signature')
+        if not verify_signature(self.server.secret, body, signature):
+            self.send_response(401)
+            self.end_headers()
+            return
+
+        try:
+            event = parse_event(body)
+        except ValueError:
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        # Ignore other rooms and the bot's own replies
+        if event and event[1] in self.server.room_ids and \
+           event[2] != self.server.bot_email:
+            tracing.received(event[0])
+            self.server.events.put(event)
+
+        # Acknowledge right away, the work happens on the worker thread
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def get_message_text(webex, message_id, max_attempts=3):
+    for attempt in range(1, max_attempts + 1):
+        try:
+            return str(webex.messages.get(message_id).text)
+        except RateLimitError as rle:
+            print(f'Rate Limit Error on fetch: {rle.retry_after}')
+            metrics.rate_limits.inc(source='fetch')
+            if attempt < max_attempts:
+                time.sleep(rle.retry_after)
+        except ApiError as err:
+            print(f'Failed to fetch message {message_id}: {err}')
+            return None
+
+    print(f'Failed to fetch message {message_id}: rate limited')
+    return None
+
+
+def process_batch(webex, batch, dispatch, replies, state=None):
+    # Build the commands to be parsed (id, command, email)
+    command_message_list = list()
+    message_rooms = dict()
+    for (message_id, room_id, email) in batch:
+        with tracing.span('fetch', [message_id], source='webhook'):
+            text = get_message_text(webex, message_id)
+        if text is None:
+            continue
+
+        command_message_list.append((message_id, text, str(email)))
+        message_rooms[message_id] = room_id
+
+    # Webex retries webhooks, skip anything already answered
+    if state:
+        command_message_list = state.unfinished(command_message_list)
+        for cmd in command_message_list:
+            state.received(message_rooms[cmd[0]], [cmd])
+
+    try:
+        response_message = dispatch(command_message_list)
+    except Exception as err:
+        print(f'Webhook batch failed: {err!r}')
+        response_message = [
+            (id, parser.COMMAND_ERROR) for (id, msg, email) in
+            command_message_list
+        ]
+
+    for (id, response) in response_message:
+        if state:
+            state.processed(message_rooms[id], [(id, response)])
+        replies.put(message_rooms[id], response, parent_id=id)
+
+    if state:
+        state.flush()
+
+
+def process_events(webex, events, dispatch, replies, state=None):
+    """Worker loop: one failed batch is logged, the next is still processed"""
+    while True:
+        batch = engine.next_batch(events)
+        try:
+            process_batch(webex, batch, dispatch, replies, state)
+        except Exception:
+            traceback.print_exc()
+
+
+def register_webhooks(webex, room_ids, target_url, secret):
+    """Create a messages/created webhook per room unless one already exists"""
+    existing = {
+        (hook.targetUrl, hook.filter) for hook in webex.webhooks.list()
+    }
+
+    for room_id in room_ids:
+        filter = f'roomId={room_id}&mentionedPeople=me'
+        if (target_url, filter) in existing:
+            continue
+
+        webex.webhooks.create(
+            name='maestro-poller-service', targetUrl=target_url,
+            resource='messages', event='created', filter=filter,
+            secret=secret
+        )
+
+
+def initialization():
+    # Where do we listen for webhook events?
+    webhook_host = environ.get('WEBHOOK_HOST', '0.0.0.0')
+    webhook_port = environ.get('WEBHOOK_PORT', '9000')
+
+    # Shared secret configured on the Webex webhook
+    webhook_secret = environ.get('WEBHOOK_SECRET')
+    if not webhook_secret:
+        raise Exception('WEBHOOK_SECRET env var is required.')
+
+    webex = startup.webex_api()
+    webex_room_ids = [
+        room_id for (title, room_id) in startup.webex_rooms(webex)
+    ]
+
+    conductor = startup.conductor_service()
+
+    server = ThreadingHTTPServer(
+        (webhook_host, int(webhook_port)), webhook_handler
+    )
+    server.secret = webhook_secret
+    server.room_ids = set(webex_room_ids)
+    server.events = queue.Queue()
+    server.bot_email = None
+
+    return server, conductor, webex, webex_room_ids
+
+
+if __name__ == '__main__':
+
+    server, conductor, webex, webex_room_ids = initialization()
+
+    # Our own messages also trigger the webhook when they mention us
+    server.bot_email = webex.people.me().emails[0]
+
+    # Optionally create the Webex webhooks pointing at this service
+    target_url = environ.get('WEBHOOK_TARGET_URL')
+    if target_url:
+        register_webhooks(webex, webex_room_ids, target_url, server.secret)
+
+    # Journal of processed messages, if state is kept
+    state = startup.checkpoint_store()
+
+    dispatch = startup.batch_dispatcher(conductor)
+    replies = startup.reply_queue(webex, state)
+    startup.reservation_index(
+        conductor, webex, webex_room_ids, replies, state
+    )
+    startup.observability(replies, conductor)
+
+    # Replies computed before a restart that never made it out, and
+    # chunked replies (not stored) computed again
+    if state:
+        for room_id in webex_room_ids:
+            replies.put_responses(room_id, state.unsent(room_id))
+            resend = dispatch(state.resend(room_id))
+            state.processed(room_id, resend)
+            replies.put_responses(room_id, resend)
+
+    # If the worker ever stops, stop answering webhooks too (and exit
+    # non-zero) rather than acknowledging events nobody will process
+    def run_worker():
+        try:
+            process_events(webex, server.events, dispatch, replies, state)
+        finally:
+            print('Webhook event worker stopped, shutting down')
+            server.shutdown()
+
+    worker = threading.Thread(
+        target=run_worker, name='webhook-events', daemon=True
+    )
+    worker.start()
+
+    print(f'Listening for webhook events on port {server.server_port}...')
+    server.serve_forever()
+    raise SystemExit('Webhook event worker stopped')
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for Webex: post a signed messages/created webhook event to
+the webhook receiver (poller/webhook.py).
+
+    WEBHOOK_SECRET=secret python scripts/webhook-post.py \
+        --url http://localhost:9000/ --room-id ROOM_ID --message-id MSG_ID
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+from os import environ
+
+import requests
+
+
+def main():
+    example = os.path.join(
+        os.path.dirname(__file__), '..', 'research', 'example.message.json'
+    )
+    with open(example) as example_file:
+        data = json.load(example_file)
+
+    args = argparse.ArgumentParser()
+    args.add_argument('--url', default='http://localhost:9000/')
+    args.add_argument('--room-id', default=data['roomId'])
+    args.add_argument('--message-id', default=data['id'])
+    args.add_argument('--email', default=data['personEmail'])
+    opts = args.parse_args()
+
+    # Webhook payloads carry the message metadata, never the text
+    data.pop('text', None)
+    data.pop('html', None)
+    data.update(
+        {'id': opts.message_id, 'roomId': opts.room_id,
+         'personEmail': opts.email}
+    )
+
+    event = {
+        'id': 'local-webhook',
+        'name': 'maestro-poller-service',
+        'resource': 'messages',
+        'event': 'created',
+        'data': data,
+    }
+
+    body = json.dumps(event).encode()
+    secret = environ.get('WEBHOOK_SECRET', '')
+    signature = hmac.new(secret.encode(), body, hashlib.sha1).hexdigest()
+
+    response = requests.post(
+        opts.url, data=body,
+        headers={
+            'Content-Type': 'application/json',
+            'X-Spark-Signature': signature,
+        }
+    )
+    print(response.status_code)
+
+
+if __name__ == '__main__':
+    main()